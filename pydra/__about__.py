@@ -66,6 +66,7 @@ REQUIRES = [
     'dataclasses; python_version < "3.7"',
     "cloudpickle",
     "filelock",
+    "numpy",
 ]
 
 SETUP_REQUIRES = ["setuptools>=27.0"]
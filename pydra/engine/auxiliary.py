@@ -2,6 +2,7 @@ import pdb
 import itertools
 from copy import deepcopy
 import logging
+import numpy as np
 from .helpers import ensure_list
 
 logger = logging.getLogger('pydra')
@@ -504,7 +505,6 @@ def input_shape(in1):
 def _splits(splitter_rpn, inputs, inner_inputs=None):
     """ Process splitter rpn from left to right
     """
-    import numpy as np
     stack = []
     keys = []
     shapes = {}
@@ -630,6 +630,39 @@ def _splits(splitter_rpn, inputs, inner_inputs=None):
     return val, keys, shapes, keys_fromLeftSpl
 
 
+def splits_indices(splitter_rpn, inputs):
+    """ Process splitter rpn from left to right (similar to _splits),
+    but returns state indices as an integer array of shape (number of states, number of keys)
+    and keys (one key per column).
+    Can't be used for splitters with inner inputs or with splitters from other states.
+    """
+    stack = []
+    for token in splitter_rpn:
+        if token in ['.', '*']:
+            indR, keysR, shapeR = stack.pop()
+            indL, keysL, shapeL = stack.pop()
+            if token == '.':
+                if shapeL != shapeR:
+                    raise ValueError('Operands {} and {} do not have same shape.'.format(
+                        keysR[0] if len(keysR) == 1 else tuple(keysR),
+                        keysL[0] if len(keysL) == 1 else tuple(keysL)))
+                ind = np.hstack([indL, indR])
+                newshape = shapeR
+            else:
+                # outer product: broadcasting left and right indices to (nL, nR, nr of keys)
+                ind = np.empty((len(indL) * len(indR), len(keysL) + len(keysR)), dtype=np.intp)
+                ind_3d = ind.reshape(len(indL), len(indR), -1)
+                ind_3d[:, :, :len(keysL)] = indL[:, None, :]
+                ind_3d[:, :, len(keysL):] = indR[None, :, :]
+                newshape = tuple(shapeL) + tuple(shapeR)
+            stack.append((ind, keysL + keysR, newshape))
+        else: # name of one of the inputs
+            shape = input_shape(inputs[token])
+            stack.append((np.arange(np.prod(shape), dtype=np.intp)[:, None], [token], shape))
+    ind, keys, _ = stack.pop()
+    return ind, keys
+
+
 # dj: TODO: do I need keys?
 def _splits_groups(splitter_rpn, combiner=None, inner_inputs=None):
     """ Process splitter rpn from left to right
@@ -800,8 +833,12 @@ def splits(splitter, inputs, inner_inputs=None):
 
 
 def map_splits(split_iter, inputs):
+    inputs_flat = {}
     for split in split_iter:
-        yield {k: list(flatten(ensure_list(inputs[k])))[v] for k,v in split.items()}
+        for k in split:
+            if k not in inputs_flat:
+                inputs_flat[k] = list(flatten(ensure_list(inputs[k])))
+        yield {k: inputs_flat[k][v] for k,v in split.items()}
 
 
 '''
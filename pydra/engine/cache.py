@@ -0,0 +1,145 @@
+"""Limits for the cache directories: size, age, least recently used results are removed."""
+
+import os
+from pathlib import Path
+import shutil
+import socket
+import time
+
+from filelock import FileLock, Timeout
+
+# directory with pins of the results used by the running workflows
+PINS_DIR = "_pins"
+
+
+class CacheManager:
+    """
+    Managing a cache directory, every task has a directory named by the checksum.
+
+    Results are removed by gc if they are older than max_age_days
+    (time of the last use), and the least recently used results are removed
+    till the size of the cache is smaller than max_size_gb.
+    Results of the running tasks and pinned results are never removed.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=None, max_age_days=None):
+        self.cache_dir = Path(cache_dir)
+        self.max_size_gb = max_size_gb
+        self.max_age_days = max_age_days
+
+    def entries(self):
+        """list of (directory, size in bytes, time of the last use) for all tasks,
+        starting from the least recently used
+        """
+        entries = []
+        if not self.cache_dir.exists():
+            return entries
+        for path in self.cache_dir.iterdir():
+            if not path.is_dir() or path.name.startswith("_"):
+                continue
+            entries.append((path, _dir_size(path), path.stat().st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size_gb(self):
+        return sum(size for _, size, _ in self.entries()) / 1024**3
+
+    def pin(self, checksum, token):
+        """result is not removed while the current process is running,
+        token: owner of the pin (e.g. a submitter), so the result stays pinned
+        till all owners from the process unpin it
+        """
+        pins_dir = self.cache_dir / PINS_DIR
+        pins_dir.mkdir(parents=True, exist_ok=True)
+        (pins_dir / _pin_name(checksum, token)).touch()
+
+    def unpin(self, checksum, token):
+        pin = self.cache_dir / PINS_DIR / _pin_name(checksum, token)
+        if pin.exists():
+            pin.unlink()
+
+    def pinned(self):
+        """checksums pinned by the running processes, pins of finished processes
+        are removed (only from the current host, the cache can be on a shared filesystem)
+        """
+        pins_dir = self.cache_dir / PINS_DIR
+        checksums = set()
+        if not pins_dir.exists():
+            return checksums
+        host = socket.gethostname()
+        for pin in pins_dir.iterdir():
+            # checksum.token.hostname.pid (checksums and tokens have no dots,
+            # hostnames can have)
+            checksum, _, rest = pin.name.partition(".")
+            pin_host, _, pid = rest.partition(".")[2].rpartition(".")
+            if pin_host != host or _pid_exists(int(pid)):
+                checksums.add(checksum)
+            else:
+                pin.unlink()
+        return checksums
+
+    def gc(self):
+        """removing results that are too old and the least recently used results
+        (if the cache is too large), returns the list of removed directories
+        """
+        pinned = self.pinned()
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        removed = []
+        for path, size, last_used in entries:
+            too_old = (
+                self.max_age_days is not None
+                and time.time() - last_used > self.max_age_days * 24 * 3600
+            )
+            too_large = (
+                self.max_size_gb is not None and total_size > self.max_size_gb * 1024**3
+            )
+            if not (too_old or too_large) or path.name in pinned:
+                continue
+            if self._remove(path):
+                removed.append(path)
+                total_size -= size
+        return removed
+
+    def _remove(self, path):
+        """removing the directory if the task is not running (the lock can be acquired)"""
+        lockfile = self.cache_dir / (path.name + ".lock")
+        try:
+            with FileLock(str(lockfile), timeout=0):
+                shutil.rmtree(path)
+        except Timeout:
+            return False
+        return True
+
+
+def touch(path):
+    """saving the time of the last use of the result (used by CacheManager)"""
+    try:
+        os.utime(path)
+    except OSError:
+        # results from read-only locations
+        pass
+
+
+def _dir_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _pin_name(checksum, token):
+    return "{}.{}.{}.{}".format(checksum, token, socket.gethostname(), os.getpid())
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
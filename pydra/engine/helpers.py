@@ -2,9 +2,16 @@ import asyncio
 import asyncio.subprocess as asp
 import dataclasses as dc
 import cloudpickle as cp
+from functools import partial
+import io
+import mmap
 from pathlib import Path
 import os
+import pickle as pk
 import sys
+import threading
+
+import numpy as np
 
 from .specs import Runtime
 
@@ -17,6 +24,13 @@ def ensure_list(obj):
     return [obj]
 
 
+def get_available_cpus():
+    """number of cores the current process is allowed to use"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
 def print_help(obj):
     help = ["Help for {}".format(obj.__class__.__name__)]
     input_klass = make_klass(obj.input_spec)
@@ -48,19 +62,156 @@ def load_result(checksum, cache_locations):
     if not cache_locations:
         return None
     for location in cache_locations:
-        if (location / checksum).exists():
-            result_file = location / checksum / "_result.pklz"
-            if result_file.exists():
-                return cp.loads(result_file.read_bytes())
-            return None
+        result_file = Path(location) / checksum / "_result.pklz"
+        if result_file.exists():
+            return read_result(result_file)
     return None
 
 
-def save_result(result_path: Path, result):
-    with (result_path / "_result.pklz").open("wb") as fp:
+def save_result(result_path: Path, result, format=None):
+    """saving the result in one of the result_formats (RESULT_FORMAT by default)"""
+    save, _ = result_formats[format or RESULT_FORMAT]
+    save(result_path / "_result.pklz", result)
+
+
+def read_result(result_file):
+    """reading the result, the format is set in the header
+    (files without the header are cloudpickled results)
+    """
+    with result_file.open("rb") as fp:
+        header = pk.load(fp)
+        if isinstance(header, dict) and header.get("format") in result_formats:
+            _, load = result_formats[header["format"]]
+            return load(fp, header, result_file)
+    return header
+
+
+def _save_cloudpickle(result_file, result):
+    with result_file.open("wb") as fp:
         cp.dump(result, fp)
 
 
+def _load_cloudpickle(fp, header, result_file):
+    return cp.load(fp)
+
+
+# buffers smaller than this are kept in the pickle
+OOB_MIN_BYTES = 2**16
+# alignment of the buffers in the file
+OOB_ALIGN = 64
+
+
+class MappedArray(np.memmap):
+    """read-only array memory-mapped from the file with the result buffers,
+    it's pickled as a handle (file, offset, dtype, shape), so the data is not copied
+    when the array is sent to other processes (the file is mapped again)
+    """
+
+    _handle = None
+
+    @classmethod
+    def open(cls, filename, offset, dtype, shape):
+        arr = cls(filename, dtype=np.dtype(dtype), mode="r", offset=offset, shape=shape)
+        arr._handle = (str(filename), offset, dtype, shape)
+        return arr
+
+    def __array_finalize__(self, obj):
+        super().__array_finalize__(obj)
+        # views and results of operations are not the mapped array
+        self._handle = None
+
+    def __reduce__(self):
+        if self._handle is None:
+            return np.asarray(self).__reduce__()
+        return (MappedArray.open, self._handle)
+
+
+class _BuffersPickler(cp.CloudPickler):
+    """large arrays are written to the buffers file and pickled as persistent ids,
+    other large buffers are saved out-of-band
+    """
+
+    def __init__(self, file, buffers_fp, buffers):
+        super().__init__(file, protocol=5, buffer_callback=self.buffer_callback)
+        self.buffers_fp = buffers_fp
+        self.buffers = buffers
+
+    def _write(self, raw):
+        self.buffers_fp.write(b"\0" * (-self.buffers_fp.tell() % OOB_ALIGN))
+        offset = self.buffers_fp.tell()
+        self.buffers_fp.write(raw)
+        return offset
+
+    def persistent_id(self, obj):
+        if (
+            type(obj) in (np.ndarray, MappedArray)
+            and obj.nbytes >= OOB_MIN_BYTES
+            and obj.dtype.fields is None
+            and not obj.dtype.hasobject
+        ):
+            arr = np.ascontiguousarray(obj)
+            offset = self._write(arr.reshape(-1).view(np.uint8).data)
+            return ("array", offset, arr.dtype.str, arr.shape)
+        return None
+
+    def buffer_callback(self, buffer):
+        raw = buffer.raw()
+        if raw.nbytes < OOB_MIN_BYTES:
+            return True
+        self.buffers.append((self._write(raw), raw.nbytes))
+        return False
+
+
+def _save_buffers(result_file, result):
+    """pickle protocol 5, large arrays (and other large buffers) are saved
+    in _result.buffers, arrays are memory-mapped (MappedArray) when the result is read
+    """
+    # the old file can be memory-mapped by readers, so it's replaced, not overwritten
+    buffers_file = result_file.parent / "_result.buffers"
+    buffers_tmp = buffers_file.with_suffix(".tmp")
+    buffers = []
+    payload = io.BytesIO()
+    with buffers_tmp.open("wb") as fp:
+        _BuffersPickler(payload, fp, buffers).dump(result)
+        has_buffers = fp.tell() > 0
+    if has_buffers:
+        os.replace(buffers_tmp, buffers_file)
+    else:
+        buffers_tmp.unlink()
+    with result_file.open("wb") as fp:
+        pk.dump({"format": "buffers", "buffers": buffers}, fp)
+        fp.write(payload.getvalue())
+
+
+def _load_buffers(fp, header, result_file):
+    buffers_file = result_file.parent / "_result.buffers"
+    buffers = []
+    if header["buffers"]:
+        with buffers_file.open("rb") as fp_buf:
+            buffers_map = memoryview(
+                mmap.mmap(fp_buf.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+        buffers = [
+            buffers_map[start : start + size] for start, size in header["buffers"]
+        ]
+    unpickler = pk.Unpickler(fp, buffers=buffers)
+    unpickler.persistent_load = partial(_load_array, buffers_file)
+    return unpickler.load()
+
+
+def _load_array(buffers_file, pid):
+    _, offset, dtype, shape = pid
+    return MappedArray.open(buffers_file, offset, dtype, shape)
+
+
+# formats of the results: name: (save function, load function)
+result_formats = {
+    "cloudpickle": (_save_cloudpickle, _load_cloudpickle),
+    "buffers": (_save_buffers, _load_buffers),
+}
+RESULT_FORMAT = "buffers" if pk.HIGHEST_PROTOCOL >= 5 else "cloudpickle"
+
+
 def task_hash(task_obj):
     """
     input hash, output hash, environment hash
@@ -92,21 +243,53 @@ def gather_runtime_info(fname):
     return runtime
 
 
+# classes created by make_klass, key: fingerprint of the SpecInfo
+_klasses = {}
+_klasses_max = 1024
+_klasses_lock = threading.Lock()
+
+
 def make_klass(spec):
+    """dataclass for the spec, the class is created only once for the same spec"""
     if spec is None:
         return None
-    return dc.make_dataclass(spec.name, spec.fields, bases=spec.bases)
+    key = _spec_fingerprint(spec)
+    if key is None:
+        return dc.make_dataclass(spec.name, spec.fields, bases=spec.bases)
+    with _klasses_lock:
+        if key not in _klasses:
+            if len(_klasses) >= _klasses_max:
+                _klasses.pop(next(iter(_klasses)))
+            _klasses[key] = dc.make_dataclass(spec.name, spec.fields, bases=spec.bases)
+        return _klasses[key]
+
+
+def _spec_fingerprint(spec):
+    """name, fields (with types of the defaults) and bases of the spec,
+    None if the fields can't be hashed (e.g. a list as a default)
+    """
+    fields = tuple(
+        tuple(field) + tuple(type(el) for el in field[2:])
+        if isinstance(field, (list, tuple))
+        else field
+        for field in spec.fields
+    )
+    key = (spec.name, fields, tuple(spec.bases))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
 
 # https://stackoverflow.com/questions/17190221
-@asyncio.coroutine
-def read_stream_and_display(stream, display):
+async def read_stream_and_display(stream, display):
     """Read from stream line by line until EOF, display, and capture the lines.
 
     """
     output = []
     while True:
-        line = yield from stream.readline()
+        line = await stream.readline()
         if not line:
             break
         output.append(line)
@@ -114,20 +297,19 @@ def read_stream_and_display(stream, display):
     return b"".join(output).decode()
 
 
-@asyncio.coroutine
-def read_and_display(*cmd):
+async def read_and_display(*cmd, cwd=None):
     """Capture cmd's stdout, stderr while displaying them as they arrive
     (line by line).
 
     """
     # start process
-    process = yield from asyncio.create_subprocess_exec(
-        *cmd, stdout=asp.PIPE, stderr=asp.PIPE
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asp.PIPE, stderr=asp.PIPE, cwd=cwd
     )
 
     # read child's stdout/stderr concurrently (capture and display)
     try:
-        stdout, stderr = yield from asyncio.gather(
+        stdout, stderr = await asyncio.gather(
             read_stream_and_display(process.stdout, sys.stdout.buffer.write),
             read_stream_and_display(process.stderr, sys.stderr.buffer.write),
         )
@@ -136,7 +318,7 @@ def read_and_display(*cmd):
         raise
     finally:
         # wait for the process to exit
-        rc = yield from process.wait()
+        rc = await process.wait()
     return rc, stdout, stderr
 
 
@@ -144,18 +326,27 @@ def read_and_display(*cmd):
 def execute(cmd):
     if os.name == "nt":
         loop = asyncio.ProactorEventLoop()  # for subprocess' pipes on Windows
-        asyncio.set_event_loop(loop)
     else:
-        if asyncio.get_event_loop().is_closed():
-            asyncio.set_event_loop(asyncio.new_event_loop())
-        loop = asyncio.get_event_loop()
-    rc, stdout, stderr = loop.run_until_complete(read_and_display(*cmd))
-    loop.close()
+        loop = asyncio.new_event_loop()
+    try:
+        rc, stdout, stderr = loop.run_until_complete(read_and_display(*cmd))
+    finally:
+        loop.close()
     return rc, stdout, stderr
 
 
-def create_checksum(name, inputs):
-    return "_".join((name, inputs.hash))
+async def execute_async(cmd, cwd=None):
+    """running cmd as a child process of the running event loop"""
+    return await read_and_display(*cmd, cwd=cwd)
+
+
+def create_checksum(name, inputs, index=None, field_hashes=None):
+    """index: HashIndex used for the files from the inputs,
+    field_hashes: hashes of the inputs computed before (see hash_spec)
+    """
+    from .helpers_file import hash_spec
+
+    return "_".join((name, hash_spec(inputs, index, field_hashes)))
 
 
 def get_inputs(needed_outputs):
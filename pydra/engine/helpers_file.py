@@ -0,0 +1,238 @@
+"""Hashing of the task inputs, files and directories are hashed by content."""
+
+from contextlib import contextmanager
+import dataclasses as dc
+from hashlib import sha256
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import typing as ty
+
+import numpy as np
+
+from .specs import File, Directory
+
+logger = logging.getLogger("pydra")
+
+# size of the blocks read from the hashed files
+BLOCKSIZE = 2**20
+
+# hashes of the files contents, key: (path, inode, size, mtime), value: hash
+_file_hashes = {}
+_file_hashes_max = 10000
+_file_hashes_lock = threading.Lock()
+
+# indices opened by the process, key: path of the database
+_hash_indices = {}
+_hash_indices_lock = threading.Lock()
+
+
+def hash_spec(spec, index=None, field_hashes=None):
+    """hash of a spec (dataclass instance) that is deterministic across processes,
+    fields with File or Directory types are hashed by the content
+    (index: HashIndex with hashes of the files, see hash_index);
+    the spec hash is combined from the hashes of the fields (hash_field),
+    field_hashes: hashes of some fields computed before
+    (e.g. the inputs shared by all state elements of a node)
+    """
+    hasher = sha256()
+    hasher.update("{}(".format(spec.__class__.__name__).encode())
+    for field in dc.fields(spec):
+        if field_hashes and field.name in field_hashes:
+            field_hash = field_hashes[field.name]
+        else:
+            field_hash = hash_field(spec, field, index)
+        hasher.update("{}={};".format(field.name, field_hash).encode())
+    hasher.update(b")")
+    return hasher.hexdigest()
+
+
+def hash_field(spec, field, index=None):
+    """hash of one field (dataclasses.Field) of the spec"""
+    return hash_value(getattr(spec, field.name), field.type, index)
+
+
+def hash_value(value, tp=None, index=None):
+    """hash of any value, tp is the expected type (e.g. File)"""
+    hasher = sha256()
+    _update_hash(hasher, value, tp, index)
+    return hasher.hexdigest()
+
+
+def hash_file(path, index=None):
+    """hash of the file content,
+    saved for the file path, inode, size and modification time,
+    so the file is read only once (also by other processes if the index is used)
+    """
+    path = Path(path).absolute()
+    stat = path.stat()
+    key = (str(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        file_hash = _file_hashes.get(key)
+    if file_hash is not None:
+        return file_hash
+    file_hash = index.get(key) if index else None
+    if file_hash is None:
+        file_hash = _read_hash(path)
+        if index:
+            index.set(key, file_hash)
+    with _file_hashes_lock:
+        if len(_file_hashes) >= _file_hashes_max:
+            _file_hashes.pop(next(iter(_file_hashes)))
+        _file_hashes[key] = file_hash
+    return file_hash
+
+
+def hash_index(location):
+    """persistent index of the files hashes saved in the directory
+    (e.g. the cache directory), None if location is None
+    """
+    if location is None:
+        return None
+    path = Path(location) / "_file_hashes.sqlite"
+    with _hash_indices_lock:
+        if path not in _hash_indices:
+            _hash_indices[path] = HashIndex(path)
+        return _hash_indices[path]
+
+
+class HashIndex:
+    """persistent index with hashes of the files contents (sqlite database),
+    key: (path, inode, size, mtime_ns); the database is created when the first hash is saved,
+    many processes can read and write at the same time;
+    the index is only a cache: errors (e.g. the cache directory was removed) are logged
+    and the file is hashed again
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def get(self, key):
+        if not self.path.exists():
+            return None
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT hash FROM file_hashes "
+                    "WHERE path=? AND inode=? AND size=? AND mtime_ns=?",
+                    key,
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("hash index {} not read: {}".format(self.path, e))
+            return None
+        return row[0] if row else None
+
+    def set(self, key, file_hash):
+        try:
+            with self._connect() as conn:
+                # one row per path, the old hash is replaced after the file is modified
+                conn.execute(
+                    "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)",
+                    key + (file_hash,),
+                )
+        except sqlite3.Error as e:
+            logger.warning("hash index {} not saved: {}".format(self.path, e))
+
+    @contextmanager
+    def _connect(self):
+        """new connection for every operation, so it can be used after fork and in threads;
+        the table is created by every connection (the database can be removed with the cache),
+        the default (rollback) journal is used, WAL doesn't work on network filesystems
+        """
+        conn = sqlite3.connect(str(self.path), timeout=60)
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, "
+                "inode INTEGER, size INTEGER, mtime_ns INTEGER, hash TEXT)"
+            )
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def hash_dir(path, index=None):
+    """hash of the directory, includes the relative paths and contents of all files"""
+    path = Path(path).absolute()
+    hasher = sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = Path(dirpath) / filename
+            hasher.update(str(file_path.relative_to(path)).encode())
+            hasher.update(hash_file(file_path, index).encode())
+    return hasher.hexdigest()
+
+
+def _read_hash(path):
+    hasher = sha256()
+    with path.open("rb") as fp:
+        for block in iter(lambda: fp.read(BLOCKSIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _update_hash(hasher, value, tp=None, index=None):
+    """updating the hasher with the value, every value is preceded by its type"""
+    if _is_path_type(tp, File) and _is_path(value) and Path(value).is_file():
+        hasher.update(b"File:" + hash_file(value, index).encode())
+    elif _is_path_type(tp, Directory) and _is_path(value) and Path(value).is_dir():
+        hasher.update(b"Directory:" + hash_dir(value, index).encode())
+    elif dc.is_dataclass(value) and not isinstance(value, type):
+        hasher.update("{}(".format(value.__class__.__name__).encode())
+        for field in dc.fields(value):
+            hasher.update("{}=".format(field.name).encode())
+            _update_hash(hasher, getattr(value, field.name), field.type, index)
+        hasher.update(b")")
+    elif isinstance(value, dict):
+        hasher.update(b"dict:{")
+        for key in sorted(value, key=repr):
+            _update_hash(hasher, key)
+            _update_hash(hasher, value[key], _item_type(tp, 1), index)
+        hasher.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        hasher.update("{}:[".format(value.__class__.__name__).encode())
+        for el in value:
+            _update_hash(hasher, el, _item_type(tp, 0), index)
+        hasher.update(b"]")
+    elif isinstance(value, (set, frozenset)):
+        hasher.update(b"set:{")
+        el_hashes = (hash_value(el, _item_type(tp, 0), index) for el in value)
+        for el_hash in sorted(el_hashes):
+            hasher.update(el_hash.encode())
+        hasher.update(b"}")
+    elif isinstance(value, (bytes, bytearray)):
+        hasher.update(b"bytes:")
+        hasher.update(value)
+    elif isinstance(value, np.ndarray):
+        # the buffer is hashed, str of the array is truncated for large arrays
+        if value.dtype == object:
+            _update_hash(hasher, value.tolist())
+        else:
+            hasher.update(
+                "ndarray:{}:{}:".format(value.dtype.str, value.shape).encode()
+            )
+            hasher.update(np.ascontiguousarray(value).data)
+    else:
+        hasher.update("{}:{!r}".format(value.__class__.__name__, value).encode())
+
+
+def _is_path(value):
+    return isinstance(value, (str, os.PathLike))
+
+
+def _is_path_type(tp, path_type):
+    """checking if tp is path_type (File or Directory) or a Union with path_type"""
+    if tp is path_type:
+        return True
+    return getattr(tp, "__origin__", None) is ty.Union and path_type in tp.__args__
+
+
+def _item_type(tp, ind):
+    """type of the elements for List[File], Dict[str, File], etc."""
+    args = getattr(tp, "__args__", None)
+    if getattr(tp, "__origin__", None) is ty.Union or not args:
+        return None
+    return args[min(ind, len(args) - 1)]
@@ -0,0 +1,177 @@
+"""History of the resources used by the tasks, used to estimate requirements of new runs."""
+
+from contextlib import contextmanager
+import dataclasses as dc
+from hashlib import sha256
+import logging
+import math
+import os
+from pathlib import Path
+import sqlite3
+import time
+
+import numpy as np
+
+from .cache import _dir_size
+from .helpers_file import _is_path, _is_path_type, _item_type
+from .specs import File, Directory
+
+logger = logging.getLogger("pydra")
+
+HISTORY_FILE = "_resource_history.sqlite"
+# number of the most recent runs used for the estimate
+HISTORY_RUNS = 20
+# the estimated memory is larger than the peak memory from the history
+MEM_MARGIN = 1.2
+
+# histories opened by the process, key: path of the database
+_histories = {}
+
+
+class ResourceHistory:
+    """
+    Peak memory, cpu and duration of the finished runs (sqlite database),
+    runs are grouped by the task type and the size class of the inputs
+    (log2 of the size of files, directories and arrays).
+    Many processes can read and write at the same time.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def record(self, node, runtime):
+        """saving the runtime (rss_peak_gb, cpu_peak_percent, duration_sec) of the node"""
+        if runtime is None or runtime.rss_peak_gb is None:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    task_type(node),
+                    size_class(node.inputs),
+                    runtime.rss_peak_gb,
+                    runtime.cpu_peak_percent,
+                    runtime.duration_sec,
+                    time.time(),
+                ),
+            )
+
+    def estimate(self, node):
+        """estimated requirements of the node (dictionary with cpu and mem_gb),
+        None if the task hasn't been run before
+        """
+        runs, scale = self._recent_runs(node)
+        if not runs:
+            return None
+        # memory is assumed to grow linearly with the inputs size
+        mem_gb = max(run[0] for run in runs) * MEM_MARGIN * scale
+        cpu_percent = max(run[1] or 0 for run in runs)
+        return {"cpu": max(1, math.ceil(cpu_percent / 100)), "mem_gb": mem_gb}
+
+    def duration(self, node):
+        """estimated duration of the node in seconds (mean of the recent runs),
+        None if the task hasn't been run before
+        """
+        runs, scale = self._recent_runs(node)
+        durations = [run[2] for run in runs if run[2] is not None]
+        if not durations:
+            return None
+        return sum(durations) / len(durations) * scale
+
+    def _recent_runs(self, node):
+        """runs of the task with the same size class of the inputs,
+        otherwise the closest one (larger are preferred);
+        returns the runs and the ratio of the inputs sizes
+        """
+        if not self.path.exists():
+            return [], 1
+        key = task_type(node)
+        size = size_class(node.inputs)
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT size_class FROM runs WHERE task=? "
+                    "ORDER BY ABS(size_class - ?), size_class DESC LIMIT 1",
+                    (key, size),
+                ).fetchone()
+                if row is None:
+                    return [], 1
+                runs = conn.execute(
+                    "SELECT rss_peak_gb, cpu_peak_percent, duration_sec FROM runs "
+                    "WHERE task=? AND size_class=? ORDER BY time DESC LIMIT ?",
+                    (key, row[0], HISTORY_RUNS),
+                ).fetchall()
+        except sqlite3.Error as e:
+            # the history is used only for estimates
+            logger.warning("resource history {} not read: {}".format(self.path, e))
+            return [], 1
+        return runs, 2 ** max(size - row[0], 0)
+
+    @contextmanager
+    def _connect(self):
+        """new connection for every operation, so it can be used after fork and in threads;
+        the table is created by every connection (the database can be removed with the cache),
+        the default (rollback) journal is used, WAL doesn't work on network filesystems
+        """
+        conn = sqlite3.connect(str(self.path), timeout=60)
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs (task TEXT, size_class INTEGER, "
+                "rss_peak_gb REAL, cpu_peak_percent REAL, duration_sec REAL, "
+                "time REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS runs_task ON runs (task, size_class)"
+            )
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def resource_history(location):
+    """history saved in the cache directory"""
+    path = Path(location) / HISTORY_FILE
+    if path not in _histories:
+        _histories[path] = ResourceHistory(path)
+    return _histories[path]
+
+
+def task_type(node):
+    """class and version of the task, and the function or the command it runs"""
+    parts = [
+        "{}.{}".format(type(node).__module__, type(node).__qualname__),
+        str(node._task_version),
+    ]
+    func = getattr(node.inputs, "_func", None)
+    if func is not None:
+        parts.append(sha256(func).hexdigest()[:16])
+    executable = getattr(node.inputs, "executable", None)
+    if executable:
+        parts.append(str(executable))
+    return ":".join(parts)
+
+
+def size_class(inputs):
+    """log2 of the size (in bytes) of files, directories, arrays and bytes from the inputs"""
+    size = 0
+    for field in dc.fields(inputs):
+        if field.name != "_func":
+            size += _size(getattr(inputs, field.name), field.type)
+    return int(size).bit_length()
+
+
+def _size(value, tp=None):
+    if _is_path(value) and (_is_path_type(tp, File) or _is_path_type(tp, Directory)):
+        if os.path.isfile(value):
+            return os.path.getsize(value)
+        if os.path.isdir(value):
+            return _dir_size(value)
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_size(item, _item_type(tp, 0)) for item in value)
+    return 0
@@ -1,6 +1,8 @@
 """Basic compute graph elements"""
 import abc
+import asyncio
 from collections import OrderedDict
+from contextlib import contextmanager
 import dataclasses as dc
 import itertools
 import json
@@ -14,18 +16,24 @@ import pickle as pk
 from copy import deepcopy
 
 import cloudpickle as cp
-from filelock import FileLock
+from filelock import FileLock, Timeout
 import shutil
 from tempfile import mkdtemp
+import threading
+import time
 
 from . import state
 from . import auxiliary as aux
 from .specs import File, BaseSpec, RuntimeSpec, Result, SpecInfo
+from .cache import touch
+from .helpers_file import hash_field, hash_index
+from .history import resource_history
 from .helpers import (
     make_klass,
     create_checksum,
     print_help,
     load_result,
+    read_result,
     gather_runtime_info,
     save_result,
     ensure_list,
@@ -35,6 +43,9 @@ from ..utils.messenger import send_message, make_message, gen_uuid, now, AuditFl
 
 logger = logging.getLogger("pydra")
 
+# seconds between the attempts to acquire the lock of the task in run_async
+LOCK_POLL_INTERVAL = 0.1
+
 develop = True
 
 
@@ -55,6 +66,10 @@ class NodeBase:
     _runtime_hints = None
 
     _cache_dir = None  # Working directory in which to operate
+    save_node = True  # saving the node (_node.pklz) with the result
+    # task can run in a thread next to other tasks (ThreadWorker),
+    # it doesn't use the working directory or other global state of the process
+    thread_safe = False
     _references = None  # List of references for a task
 
     # dj: do we need it??
@@ -70,6 +85,7 @@ class NodeBase:
         messengers=None,
         messenger_args=None,
         cache_dir=None,
+        cache_locations=None,
     ):
         """A base structure for nodes in the computational graph (i.e. both
         ``Node`` and ``Workflow``).
@@ -121,20 +137,32 @@ class NodeBase:
         self.messengers = ensure_list(messengers)
         self.messenger_args = messenger_args
         self.cache_dir = cache_dir
+        self.cache_locations = cache_locations
 
         # dictionary of results from tasks
         self.results_dict = {}
 
     def __getstate__(self):
+        """specs are pickled with the node (not as separate pickles),
+        inputs are not copied, results and messengers (if not auditing) are not included
+        """
         state = self.__dict__.copy()
-        state["input_spec"] = pk.dumps(state["input_spec"])
-        state["output_spec"] = pk.dumps(state["output_spec"])
-        state["inputs"] = dc.asdict(state["inputs"])
+        state["inputs"] = {
+            field.name: getattr(self.inputs, field.name)
+            for field in dc.fields(self.inputs)
+        }
+        state["results_dict"] = {}
+        state["_result"] = {}
+        state["_output"] = {}
+        if not self.audit_flags:
+            state["messengers"] = []
         return state
 
     def __setstate__(self, state):
-        state["input_spec"] = pk.loads(state["input_spec"])
-        state["output_spec"] = pk.loads(state["output_spec"])
+        # nodes pickled before the specs were pickled with the node
+        if isinstance(state["input_spec"], bytes):
+            state["input_spec"] = pk.loads(state["input_spec"])
+            state["output_spec"] = pk.loads(state["output_spec"])
         state["inputs"] = make_klass(state["input_spec"])(**state["inputs"])
         self.__dict__.update(state)
 
@@ -156,18 +184,86 @@ class NodeBase:
 
     @property
     def checksum(self):
-        return create_checksum(self.__class__.__name__, self.inputs)
+        # checksum computed by the submitter for the same inputs (NodeTemplate.rehydrate)
+        known = self.__dict__.get("_known_checksum")
+        if known is not None and known[0] is self.inputs:
+            return known[1]
+        # hashes of the input files are shared by all tasks with the same cache_dir
+        return create_checksum(
+            self.__class__.__name__, self.inputs, hash_index(self.cache_dir)
+        )
 
     def ready2run(self, index=None):
-        # flag that says if the node/wf is ready to run (has all input)
-        for node, _, _ in self.needed_outputs:
-            if not node.is_finished(index=index):
+        """checking if the upstream elements that provide inputs for the element are finished"""
+        for node, ind in self.upstream_elements(index):
+            if not node.is_finished(index=ind):
                 return False
         return True
 
     def is_finished(self, index=None):
-        # TODO: check local procs
-        return False
+        """checking if the element is finished
+        (all elements if the node has a state and index is None)
+        """
+        if index is None and self.state:
+            return len(self.results_dict) == len(self.state.states_val) and bool(
+                self.done
+            )
+        future = self.results_dict.get(index)
+        return future is not None and future.done()
+
+    def upstream_elements(self, index=None):
+        """elements (node, index) of the upstream nodes that provide inputs for the element,
+        elements are matched by the values of the upstream splitter
+        """
+        elements = []
+        for from_node, _, _ in self.needed_outputs:
+            if not is_node(from_node):
+                continue
+            if from_node.state is None:
+                elements.append((from_node, None))
+            elif index is None or self.state is None or from_node.state.combiner:
+                # all elements of the upstream node are needed
+                elements += [
+                    (from_node, ind) for ind in range(len(from_node.state.states_val))
+                ]
+            else:
+                dir_nm_el_from, _ = from_node._directory_name_state_surv(
+                    self.state.states_val[index]
+                )
+                elements.append((from_node, from_node._element_index(dir_nm_el_from)))
+        return elements
+
+    def upstream_outputs(self, index=None):
+        """outputs of the upstream elements that are inputs of the element:
+        list of (node, index, output name, input name), None if the element uses
+        outputs of many elements (combiner) or of a workflow
+        """
+        outputs = []
+        for from_node, from_socket, to_socket in self.needed_outputs:
+            if not is_node(from_node):
+                return None
+            if from_node.state is None:
+                from_ind = None
+            elif index is None or self.state is None or from_node.state.combiner:
+                return None
+            else:
+                dir_nm_el_from, _ = from_node._directory_name_state_surv(
+                    self.state.states_val[index]
+                )
+                from_ind = from_node._element_index(dir_nm_el_from)
+            outputs.append((from_node, from_ind, from_socket, to_socket))
+        return outputs
+
+    def _element_index(self, dir_nm_el):
+        """index of the state element with the directory name"""
+        states_val = self.state.states_val
+        cached = getattr(self, "_element_indices", None)
+        if cached is None or cached[0] is not states_val:
+            indices = {}
+            for ind, state_dict in enumerate(states_val):
+                indices[self._directory_name_state_surv(state_dict)[0]] = ind
+            self._element_indices = cached = (states_val, indices)
+        return cached[1][dir_nm_el]
 
     @property
     def needed_outputs(self):
@@ -249,6 +345,12 @@ class NodeBase:
     def _run_task(self):
         pass
 
+    async def _run_task_async(self):
+        """tasks that can wait for the results without blocking
+        the event loop (e.g. subprocesses) should overwrite it
+        """
+        self._run_task()
+
     @property
     def cache_dir(self):
         return self._cache_dir
@@ -258,6 +360,15 @@ class NodeBase:
         if location is not None:
             self._cache_dir = Path(location)
 
+    @property
+    def cache_locations(self):
+        """read-only locations that are checked for results of previous runs"""
+        return self._cache_locations
+
+    @cache_locations.setter
+    def cache_locations(self, locations):
+        self._cache_locations = [Path(loc) for loc in ensure_list(locations)]
+
     @property
     def output_dir(self):
         return self._cache_dir / self.checksum
@@ -268,14 +379,18 @@ class NodeBase:
     def __call__(self, cache_locations=None, **kwargs):
         return self.run(cache_locations=cache_locations, **kwargs)
 
-    def run(self, cache_locations=None, cache_dir=None, **kwargs):
-        self.inputs = dc.replace(self.inputs, **kwargs)
+    def _prepare_run(self, cache_dir=None, **kwargs):
+        """updating inputs and cache_dir, returns the lockfile for the task"""
+        if kwargs:
+            self.inputs = dc.replace(self.inputs, **kwargs)
         if cache_dir is not None:
             self.cache_dir = Path(cache_dir)
         if self.cache_dir is None:
             self.cache_dir = mkdtemp()
-        checksum = self.checksum
-        lockfile = self.cache_dir / (checksum + ".lock")
+        return self.cache_dir / (self.checksum + ".lock")
+
+    def run(self, cache_locations=None, cache_dir=None, change_dir=True, **kwargs):
+        lockfile = self._prepare_run(cache_dir=cache_dir, **kwargs)
         """
         Concurrent execution scenarios
 
@@ -290,90 +405,168 @@ class NodeBase:
         with FileLock(lockfile):
             # Let only one equivalent process run
             # Eagerly retrieve cached
-            """
-            result = self.result(cache_locations=cache_locations)
+            result = self._cached_result(cache_locations=cache_locations)
             if result is not None:
                 return result
-            """
-            odir = self.output_dir
-            if not self.can_resume and odir.exists():
-                shutil.rmtree(odir)
-            cwd = os.getcwd()
-            odir.mkdir(parents=False, exist_ok=True if self.can_resume else False)
-
-            # start recording provenance, but don't send till directory is created
-            # in case message directory is inside task output directory
-            if self.audit_check(AuditFlag.PROV):
-                aid = "uid:{}".format(gen_uuid())
-                start_message = {"@id": aid, "@type": "task", "startedAtTime": now()}
-            os.chdir(odir)
-            if self.audit_check(AuditFlag.PROV):
-                self.audit(start_message, AuditFlag.PROV)
-                # audit inputs
-            # check_runtime(self._runtime_requirements)
-            # isolate inputs if files
-            # cwd = os.getcwd()
-            if self.audit_check(AuditFlag.RESOURCE):
-                from ..utils.profiler import ResourceMonitor
+            with self._running(change_dir=change_dir) as result:
+                self._run_task()
+                result.output = self._collect_outputs()
+            return result
 
-                resource_monitor = ResourceMonitor(os.getpid(), logdir=odir)
-            result = Result(output=None, runtime=None)
+    async def run_async(self, cache_locations=None, cache_dir=None, **kwargs):
+        """running the task as a coroutine, so many tasks can share one event loop,
+        the working directory of the process is not changed
+        """
+        lockfile = self._prepare_run(cache_dir=cache_dir, **kwargs)
+        # the lock is only held by the processes that run equivalent tasks,
+        # the loop is not blocked while waiting for it
+        lock = FileLock(lockfile)
+        while True:
             try:
-                if self.audit_check(AuditFlag.RESOURCE):
-                    resource_monitor.start()
-                    if self.audit_check(AuditFlag.PROV):
-                        mid = "uid:{}".format(gen_uuid())
-                        self.audit(
-                            {
-                                "@id": mid,
-                                "@type": "monitor",
-                                "startedAtTime": now(),
-                                "wasStartedBy": aid,
-                            },
-                            AuditFlag.PROV,
-                        )
-                self._run_task()
+                lock.acquire(timeout=0)
+                break
+            except Timeout:
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            result = self._cached_result(cache_locations=cache_locations)
+            if result is not None:
+                return result
+            with self._running(change_dir=False) as result:
+                await self._run_task_async()
                 result.output = self._collect_outputs()
-            except Exception as e:
-                print(e)
-                # record_error(self, e)
-                raise
-            finally:
-                if self.audit_check(AuditFlag.RESOURCE):
-                    resource_monitor.stop()
-                    result.runtime = gather_runtime_info(resource_monitor.fname)
-                    if self.audit_check(AuditFlag.PROV):
-                        self.audit(
-                            {"@id": mid, "endedAtTime": now(), "wasEndedBy": aid},
-                            AuditFlag.PROV,
-                        )
-                        # audit resources/runtime information
-                        eid = "uid:{}".format(gen_uuid())
-                        entity = dc.asdict(result.runtime)
-                        entity.update(
-                            **{
-                                "@id": eid,
-                                "@type": "runtime",
-                                "prov:wasGeneratedBy": aid,
-                            }
-                        )
-                        self.audit(entity, AuditFlag.PROV)
-                        self.audit(
-                            {
-                                "@type": "prov:Generation",
-                                "entity_generated": eid,
-                                "hadActivity": mid,
-                            },
-                            AuditFlag.PROV,
-                        )
-                save_result(odir, result)
+            return result
+        finally:
+            lock.release()
+
+    def _cached_result(self, cache_locations=None, mark_used=True):
+        """result of a previous run with the same checksum,
+        looking in cache_dir first and then in the read-only cache_locations;
+        mark_used: the output directory is touched, so it's kept by the cache cleanup
+        (not for lookups that don't use the result, e.g. Submitter.dry_run)
+        """
+        result = load_result(
+            self.checksum,
+            ensure_list(self.cache_dir)
+            + self.cache_locations
+            + ensure_list(cache_locations),
+        )
+        # failed runs also save the result, but without the output
+        if result is None or result.output is None:
+            return None
+        if mark_used and self.cache_dir is not None:
+            touch(self.output_dir)
+        return result
+
+    def _shared_result(self, result):
+        """result with large arrays memory-mapped from the saved result (MappedArray),
+        so the arrays are not copied when the result is sent to other processes
+        """
+        if (self.output_dir / "_result.buffers").exists():
+            return read_result(self.output_dir / "_result.pklz")
+        return result
+
+    def _record_history(self, runtime):
+        """saving the runtime in the resource history (used by the scheduler
+        to estimate requirements of the next runs), errors don't fail the task
+        """
+        try:
+            resource_history(self.cache_dir).record(self, runtime)
+        except Exception as e:
+            logger.warning(
+                "resource history of {} not recorded: {}".format(self.name, e)
+            )
+
+    @contextmanager
+    def _running(self, change_dir=True):
+        """creating the output directory, auditing the execution
+        and saving the result that is yielded to the caller
+        """
+        odir = self.output_dir
+        # the directory doesn't have a valid result (it was checked before running),
+        # so it's left by an interrupted or failed run
+        if not self.can_resume and odir.exists():
+            shutil.rmtree(odir)
+        cwd = os.getcwd()
+        odir.mkdir(parents=False, exist_ok=True if self.can_resume else False)
+
+        # start recording provenance, but don't send till directory is created
+        # in case message directory is inside task output directory
+        if self.audit_check(AuditFlag.PROV):
+            aid = "uid:{}".format(gen_uuid())
+            start_message = {"@id": aid, "@type": "task", "startedAtTime": now()}
+        if change_dir:
+            os.chdir(odir)
+        if self.audit_check(AuditFlag.PROV):
+            self.audit(start_message, AuditFlag.PROV)
+            # audit inputs
+        # check_runtime(self._runtime_requirements)
+        # isolate inputs if files
+        # cwd = os.getcwd()
+        if self.audit_check(AuditFlag.RESOURCE):
+            from ..utils.profiler import ResourceMonitor
+
+            resource_monitor = ResourceMonitor(os.getpid(), logdir=odir)
+        result = Result(output=None, runtime=None)
+        try:
+            if self.audit_check(AuditFlag.RESOURCE):
+                resource_monitor.start()
+                start_time = time.time()
+                if self.audit_check(AuditFlag.PROV):
+                    mid = "uid:{}".format(gen_uuid())
+                    self.audit(
+                        {
+                            "@id": mid,
+                            "@type": "monitor",
+                            "startedAtTime": now(),
+                            "wasStartedBy": aid,
+                        },
+                        AuditFlag.PROV,
+                    )
+            yield result
+        except Exception as e:
+            print(e)
+            # record_error(self, e)
+            raise
+        finally:
+            if self.audit_check(AuditFlag.RESOURCE):
+                resource_monitor.stop()
+                result.runtime = gather_runtime_info(resource_monitor.fname)
+                result.runtime.duration_sec = time.time() - start_time
+                if self.audit_check(AuditFlag.PROV):
+                    self.audit(
+                        {"@id": mid, "endedAtTime": now(), "wasEndedBy": aid},
+                        AuditFlag.PROV,
+                    )
+                    # audit resources/runtime information
+                    eid = "uid:{}".format(gen_uuid())
+                    entity = dc.asdict(result.runtime)
+                    entity.update(
+                        **{
+                            "@id": eid,
+                            "@type": "runtime",
+                            "prov:wasGeneratedBy": aid,
+                        }
+                    )
+                    self.audit(entity, AuditFlag.PROV)
+                    self.audit(
+                        {
+                            "@type": "prov:Generation",
+                            "entity_generated": eid,
+                            "hadActivity": mid,
+                        },
+                        AuditFlag.PROV,
+                    )
+            save_result(odir, result)
+            if self.audit_check(AuditFlag.RESOURCE):
+                self._record_history(result.runtime)
+            if self.save_node:
                 with open(odir / "_node.pklz", "wb") as fp:
                     cp.dump(self, fp)
+            if change_dir:
                 os.chdir(cwd)
-                if self.audit_check(AuditFlag.PROV):
-                    # audit outputs
-                    self.audit({"@id": aid, "endedAtTime": now()}, AuditFlag.PROV)
-            return result
+            if self.audit_check(AuditFlag.PROV):
+                # audit outputs
+                self.audit({"@id": aid, "endedAtTime": now()}, AuditFlag.PROV)
 
     # TODO: Decide if the following two functions should be separated
     @abc.abstractmethod
@@ -386,6 +579,15 @@ class NodeBase:
         output = output_klass(**{f.name: None for f in dc.fields(output_klass)})
         return dc.replace(output, **dict(zip(self.output_names, run_output)))
 
+    def requirements(self, cpu=None, mem_gb=None, gpu=None):
+        """setting resources required by one state element (cores, memory in GB, gpus)"""
+        resources = {"cpu": cpu, "mem_gb": mem_gb, "gpu": gpu}
+        self._runtime_requirements = dc.replace(
+            self._runtime_requirements,
+            **{key: val for key, val in resources.items() if val is not None}
+        )
+        return self
+
     # TODO: should change state!
     def split(self, splitter, **kwargs):
         if kwargs:
@@ -416,18 +618,24 @@ class NodeBase:
         except:  # TODO specify
             return False
 
-    def get_input_el(self, ind):
-        """collecting all inputs required to run the node (for specific state element)"""
+    def get_input_el(self, ind, connected=True):
+        """collecting all inputs required to run the node (for specific state element),
+        inputs from previous nodes are skipped if connected is False
+        """
         if ind is not None:
             # TODO: check if the current version requires both state_dict and inputs_dict
             state_dict = self.state.states_val[ind]
+            # inputs that are not in the splitter are the same for all elements
             inputs_dict = {
-                "{}.{}".format(self.name, k): state_dict["{}.{}".format(self.name, k)]
+                "{}.{}".format(self.name, k): state_dict.get(
+                    "{}.{}".format(self.name, k), getattr(self.inputs, k)
+                )
                 for k in self.input_names
             }
 
             # reading extra inputs that come from previous nodes
-            for (from_node, from_socket, to_socket) in self.needed_outputs:
+            needed_outputs = self.needed_outputs if connected else []
+            for (from_node, from_socket, to_socket) in needed_outputs:
                 # TODO update to new version: if previous has state, it would have to be combined
                 # if the current node has no state
                 if from_node.state.combiner:
@@ -439,10 +647,12 @@ class NodeBase:
                     dir_nm_el_from, _ = from_node._directory_name_state_surv(state_dict)
                     # TODO: do I need this if, what if this is wf?
                     if is_node(from_node):
+                        ind_from = from_node._element_index(dir_nm_el_from)
                         out_from = getattr(
-                            from_node.results_dict[dir_nm_el_from].output, from_socket
+                            from_node.results_dict[ind_from].result().output,
+                            from_socket,
                         )
-                        if out_from:
+                        if out_from is not None:
                             inputs_dict["{}.{}".format(self.name, to_socket)] = out_from
                         else:
                             raise Exception(
@@ -468,10 +678,11 @@ class NodeBase:
                 ["{}:{}".format(i, j) for i, j in list(state.items())]
             )
             if is_node(from_node):
+                ind_from = from_node._element_index(dir_nm_el_from)
                 out_from = getattr(
-                    from_node.results_dict[dir_nm_el_from].output, from_socket
+                    from_node.results_dict[ind_from].result().output, from_socket
                 )
-                if out_from:
+                if out_from is not None:
                     inputs_all.append(out_from)
                 else:
                     raise Exception("output from {} doesnt exist".format(from_node))
@@ -544,15 +755,62 @@ class NodeBase:
         )
         return dir_nm_el, state_surv_dict
 
-    def to_job(self, ind):
+    def to_job(self, ind, template=None, connected=True):
         """ running interface one element generated from node_state."""
         logger.debug("Run interface el, name={}, ind={}".format(self.name, ind))
-        el = deepcopy(self)
+        if template is None:
+            template = self.job_template()
+        return TaskJob(template=template, inputs=self._job_inputs(ind, connected))
+
+    def to_job_chunk(self, inds, template=None):
+        """ running interface for several elements generated from node_state
+        (one node template and a list with inputs of the elements)
+        """
+        logger.debug("Run interface chunk, name={}, inds={}".format(self.name, inds))
+        if template is None:
+            template = self.job_template()
+        return JobChunk(template, [self._job_inputs(ind) for ind in inds])
+
+    def job_template(self):
+        """node without state and results that is shared by all jobs of the node"""
+        el = object.__new__(type(self))
+        el.__dict__.update(self.__dict__)
+        # inputs of the elements are sent with the jobs, so the template
+        # doesn't grow with the number of elements
+        el.inputs = dc.replace(
+            self.inputs, **{name: None for name in self._element_fields()}
+        )
         el.state = None
-        _, inputs_dict = self.get_input_el(ind)
-        interf_inputs = dict((k.split(".")[1], v) for k, v in inputs_dict.items())
-        el.inputs = dc.replace(el.inputs, **interf_inputs)
-        return el
+        el.state_inputs = {}
+        el.__dict__.pop("_element_indices", None)
+        el.results_dict = {}
+        el._result = {}
+        el._needed_outputs = []
+        return NodeTemplate(el)
+
+    def _element_fields(self):
+        """inputs that are different for every element (from the splitter
+        and from other nodes), other inputs are sent once with the template
+        """
+        fields = {to_socket for _, _, to_socket in self.needed_outputs}
+        states_val = getattr(self.state, "states_val", None)
+        if states_val is not None:
+            prefix = "{}.".format(self.name)
+            fields.update(
+                key[len(prefix) :] for key in states_val.keys if key.startswith(prefix)
+            )
+        return fields
+
+    def _job_inputs(self, ind, connected=True):
+        """inputs of the interface for one element (only inputs from _element_fields)"""
+        _, inputs_dict = self.get_input_el(ind, connected)
+        fields = self._element_fields()
+        inputs = {}
+        for key, val in inputs_dict.items():
+            name = key.split(".")[1]
+            if name in fields:
+                inputs[name] = val
+        return inputs
 
     # checking if all outputs are saved
     @property
@@ -661,6 +919,197 @@ class NodeBase:
                 self._result[key_out] = (None, output[None])
 
 
+# node templates unpickled by the current (worker) process, key: NodeTemplate.key
+_templates = {}
+_templates_max = 64
+_templates_lock = threading.Lock()
+
+
+class NodeTemplate:
+    """node shared by the jobs of its elements,
+    it's pickled only once and the worker processes unpickle it once per node
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.key = gen_uuid()
+        self.path = None
+        self._pickled = None
+        self._lock = threading.Lock()
+        # hashes of the inputs shared by the elements, key: names of the element inputs
+        self._field_hashes = {}
+
+    def __getstate__(self):
+        if self.path is not None:
+            # the processes read the node from the file (once per process)
+            return {"key": self.key, "path": self.path, "_pickled": None}
+        return {"key": self.key, "path": None, "_pickled": self._pickle()}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._field_hashes = {}
+        with _templates_lock:
+            node = _templates.get(self.key)
+        if node is None:
+            if self.path is not None:
+                with open(self.path, "rb") as fp:
+                    node = cp.load(fp)
+            else:
+                node = cp.loads(self._pickled)
+            with _templates_lock:
+                if len(_templates) >= _templates_max:
+                    _templates.pop(next(iter(_templates)))
+                node = _templates.setdefault(self.key, node)
+        self.node = node
+
+    def _pickle(self):
+        with self._lock:
+            if self._pickled is None:
+                self._pickled = cp.dumps(self.node)
+        return self._pickled
+
+    def save(self, directory):
+        """saving the pickled node to the directory shared with the worker processes
+        (on the same host), so the jobs are sent only with the key and the path
+        """
+        pickled = self._pickle()
+        with self._lock:
+            if self.path is None:
+                path = Path(directory) / "{}.pklz".format(self.key)
+                path.write_bytes(pickled)
+                self.path = str(path)
+
+    def field_hashes(self, element_fields, index=None):
+        """hashes of the inputs that are the same for all elements
+        (all inputs except element_fields), computed once per node,
+        so e.g. a large array is not hashed again for every element
+        """
+        key = frozenset(element_fields)
+        with self._lock:
+            if key not in self._field_hashes:
+                inputs = self.node.inputs
+                self._field_hashes[key] = {
+                    field.name: hash_field(inputs, field, index)
+                    for field in dc.fields(inputs)
+                    if field.name not in key
+                }
+            return self._field_hashes[key]
+
+    def rehydrate(self, inputs, checksum=None):
+        """a copy of the node (without copying its attributes) with the element inputs,
+        checksum of the element is not computed again if it's known
+        """
+        node = object.__new__(type(self.node))
+        node.__dict__.update(self.node.__dict__)
+        node.inputs = dc.replace(self.node.inputs, **inputs)
+        node.results_dict = {}
+        if checksum is not None:
+            node._known_checksum = (node.inputs, checksum)
+        return node
+
+
+@dc.dataclass(frozen=True)
+class TaskJob:
+    """one state element sent to a worker: the node template and the element inputs"""
+
+    template: NodeTemplate
+    inputs: dict
+    # computed once (e.g. by the submitter to pin the result) and sent with the job
+    _checksum: ty.Optional[str] = dc.field(default=None, compare=False)
+
+    @property
+    def node(self):
+        return self.template.rehydrate(self.inputs, self._checksum)
+
+    @property
+    def cache_dir(self):
+        return self.template.node.cache_dir
+
+    @property
+    def checksum(self):
+        if self._checksum is None:
+            # hashes of the input files are saved in the index used by the workers,
+            # the inputs shared by the elements are hashed once for the template
+            node = self.node
+            index = hash_index(node.cache_dir)
+            checksum = create_checksum(
+                node.__class__.__name__,
+                node.inputs,
+                index,
+                self.template.field_hashes(self.inputs, index),
+            )
+            object.__setattr__(self, "_checksum", checksum)
+        return self._checksum
+
+    @property
+    def thread_safe(self):
+        return self.template.node.thread_safe
+
+    def __call__(self, **kwargs):
+        node = self.node
+        return node._shared_result(node.run(**kwargs))
+
+    def run_in_thread(self, change_dir=False, **kwargs):
+        """running in a thread of the submitting process,
+        the Result is passed in memory (it's not read again from the cache)
+        """
+        return self.node.run(change_dir=change_dir, **kwargs)
+
+    async def run_async(self, **kwargs):
+        node = self.node
+        return node._shared_result(await node.run_async(**kwargs))
+
+
+class JobChunk:
+    """several state elements of one node that are run as one job,
+    returns a list with a Result (or an exception) for every element
+    """
+
+    def __init__(self, template, inputs_list, checksums=None):
+        self.template = template
+        self.inputs_list = inputs_list
+        # checksums of the elements (if they are known)
+        self.checksums = checksums or [None] * len(inputs_list)
+
+    def __len__(self):
+        return len(self.inputs_list)
+
+    @property
+    def thread_safe(self):
+        return self.template.node.thread_safe
+
+    def __call__(self, **kwargs):
+        results = []
+        for inputs, checksum in zip(self.inputs_list, self.checksums):
+            try:
+                node = self.template.rehydrate(inputs, checksum)
+                results.append(node._shared_result(node.run(**kwargs)))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def run_in_thread(self, change_dir=False, **kwargs):
+        results = []
+        for inputs, checksum in zip(self.inputs_list, self.checksums):
+            try:
+                node = self.template.rehydrate(inputs, checksum)
+                results.append(node.run(change_dir=change_dir, **kwargs))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def run_async(self, **kwargs):
+        results = []
+        for inputs, checksum in zip(self.inputs_list, self.checksums):
+            try:
+                node = self.template.rehydrate(inputs, checksum)
+                results.append(node._shared_result(await node.run_async(**kwargs)))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
 class Workflow(NodeBase):
     def __init__(
         self,
@@ -672,6 +1121,7 @@ class Workflow(NodeBase):
         messengers=None,
         messenger_args=None,
         cache_dir=None,
+        cache_locations=None,
     ):
         if input_spec:
             if isinstance(input_spec, BaseSpec):
@@ -693,6 +1143,7 @@ class Workflow(NodeBase):
             name=name,
             inputs=inputs,
             cache_dir=cache_dir,
+            cache_locations=cache_locations,
             audit_flags=audit_flags,
             messengers=messengers,
             messenger_args=messenger_args,
@@ -915,9 +1366,6 @@ class Workflow(NodeBase):
             nn._done = False  # helps when mp is used
             try:
                 for inp, (out_node, out_var) in self.connected_var[nn].items():
-                    nn.ready2run = (
-                        False
-                    )  # it has some history (doesnt have to be in the loop)
                     nn.state_inputs.update(out_node.state_inputs)
                     nn.needed_outputs.append((out_node, out_var, inp))
                     # if there is no splitter provided, i'm assuming that splitter is taken from the previous node
@@ -953,3 +1401,8 @@ def is_function(obj):
 
 def is_workflow(obj):
     return isinstance(obj, Workflow)
+
+
+def is_node(obj):
+    """task (not a workflow) that can be a node of a workflow"""
+    return isinstance(obj, NodeBase) and not is_workflow(obj)
@@ -0,0 +1,220 @@
+"""Running jobs on a worker when the resources required by the tasks are available."""
+
+import concurrent.futures as cf
+from functools import partial
+import heapq
+import itertools
+import logging
+import threading
+
+import networkx as nx
+
+from .helpers import get_available_cpus
+from .history import resource_history, size_class, task_type
+from .node import JobChunk
+
+logger = logging.getLogger("pydra.workflow")
+
+RESOURCES = ("cpu", "mem_gb", "gpu")
+
+
+class ResourceScheduler:
+    """
+    Submitting jobs to the worker only if the resources required by the task
+    (cpu, mem_gb, gpu from the task runtime requirements) are available,
+    other jobs wait and are submitted when running jobs finish.
+
+    Waiting jobs are submitted starting from the highest priority
+    (e.g. the critical path of the workflow) and are packed: a job that fits
+    is submitted even if a job with a higher priority (and larger) still has to wait.
+    A job that requires more than the capacity is run when nothing else is running.
+
+    Waiting jobs are kept in heaps, one for every set of requirements,
+    so only the first job of every heap is checked when resources are released.
+    """
+
+    def __init__(self, worker, cpu=None, mem_gb=None, gpu=None, adaptive=True):
+        """
+        cpu: number of cores (nr_proc of the worker or available cores by default)
+        mem_gb: memory (total memory of the system by default)
+        gpu: number of gpus, if None gpus are only counted, not limited
+        adaptive: cpu and mem_gb not set by the task are estimated from
+            the resource history of the previous runs (recorded with AuditFlag.RESOURCE)
+        """
+        self.worker = worker
+        self.adaptive = adaptive
+        # estimates from the history, key: task type, node name and cache directory
+        # (the history is read once for every node, not for every element)
+        self._estimates = {}
+        if cpu is None:
+            cpu = getattr(worker, "nr_proc", None) or get_available_cpus()
+        if mem_gb is None:
+            mem_gb = _total_memory_gb()
+        self.capacity = {"cpu": cpu, "mem_gb": mem_gb, "gpu": gpu}
+        self.in_use = {"cpu": 0, "mem_gb": 0.0, "gpu": 0}
+        self.nr_running = 0
+        # heaps of waiting jobs (-priority, number, job, requirements, future),
+        # key: requirements (all jobs in a heap fit if the first one fits)
+        self._waiting = {}
+        self.nr_waiting = 0
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+        self._finished = threading.Condition(self._lock)
+
+    def submit(self, job, priority=0):
+        """submitting the job when resources are available, returns a future with the Result;
+        jobs with higher priority are submitted first
+        """
+        future = cf.Future()
+        future.set_running_or_notify_cancel()
+        req = self._requirements(job)
+        key = tuple(req[name] for name in RESOURCES)
+        with self._lock:
+            heapq.heappush(
+                self._waiting.setdefault(key, []),
+                (-priority, next(self._counter), job, req, future),
+            )
+            self.nr_waiting += 1
+        self._dispatch()
+        return future
+
+    def _requirements(self, job):
+        """requirements of the job, estimates from the history are cached"""
+        estimate = None
+        runtime = job.template.node._runtime_requirements
+        if self.adaptive and (runtime.cpu is None or runtime.mem_gb is None):
+            node = estimated_node(job)
+            # elements with larger inputs (e.g. files) can require more memory
+            key = (task_type(node), node.name, size_class(node.inputs), node.cache_dir)
+            if key not in self._estimates:
+                self._estimates[key] = estimate_requirements(job, node)
+            estimate = self._estimates[key]
+        return requirements(job, estimate)
+
+    def wait(self):
+        """waiting till all jobs (also the waiting ones) are finished"""
+        with self._finished:
+            self._finished.wait_for(lambda: not self.nr_waiting and not self.nr_running)
+
+    def _fits(self, req):
+        if self.nr_running == 0:
+            return True
+        for key in RESOURCES:
+            if self.capacity[key] is not None:
+                if self.in_use[key] + req[key] > self.capacity[key]:
+                    return False
+        return True
+
+    def _next_job(self):
+        """removing the waiting job with the highest priority that fits (None if no job fits)"""
+        free_cpu = self.capacity["cpu"] - self.in_use["cpu"]
+        if self.nr_running and self.capacity["cpu"] is not None and free_cpu < 1:
+            # every job requires at least one core
+            return None
+        best = None
+        for heap in self._waiting.values():
+            if (best is None or heap[0] < best[0]) and self._fits(heap[0][3]):
+                best = heap
+        if best is None:
+            return None
+        item = heapq.heappop(best)
+        if not best:
+            del self._waiting[tuple(item[3][name] for name in RESOURCES)]
+        self.nr_waiting -= 1
+        return item
+
+    def _dispatch(self):
+        """submitting waiting jobs that fit"""
+        to_submit = []
+        with self._lock:
+            while self.nr_waiting:
+                item = self._next_job()
+                if item is None:
+                    break
+                self._acquire(item[3])
+                to_submit.append(item)
+        for _, _, job, req, future in to_submit:
+            try:
+                worker_future = self.worker.run_el(job)
+            except Exception as e:
+                self._done(None, req, future, exception=e)
+                continue
+            worker_future.add_done_callback(partial(self._done, req=req, future=future))
+
+    def _acquire(self, req):
+        self.nr_running += 1
+        for key in RESOURCES:
+            self.in_use[key] += req[key]
+
+    def _done(self, worker_future, req, future, exception=None):
+        """releasing the resources and submitting waiting jobs before passing the result"""
+        with self._lock:
+            self.nr_running -= 1
+            for key in RESOURCES:
+                self.in_use[key] -= req[key]
+        self._dispatch()
+        with self._finished:
+            self._finished.notify_all()
+        if exception is None:
+            exception = worker_future.exception()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(worker_future.result())
+
+
+def critical_path(graph, durations):
+    """priority of every node of the graph: the longest path from the node to the end
+    of the graph, durations of the nodes are in seconds (1 if the node is missing)
+    """
+    priorities = {}
+    for node in reversed(list(nx.topological_sort(graph))):
+        longest = max((priorities[nd] for nd in graph.successors(node)), default=0)
+        priorities[node] = durations.get(node, 1.0) + longest
+    return priorities
+
+
+def requirements(job, estimate=None):
+    """resources required by the job (the runtime requirements of the task),
+    cpu and mem_gb that are not set are taken from the estimate
+    """
+    runtime = job.template.node._runtime_requirements
+    req = {"cpu": runtime.cpu, "mem_gb": runtime.mem_gb, "gpu": runtime.gpu or 0}
+    for key, val in (estimate or {}).items():
+        if req[key] is None:
+            req[key] = val
+    req["cpu"] = req["cpu"] or 1
+    req["mem_gb"] = req["mem_gb"] or 0.0
+    return req
+
+
+def estimate_requirements(job, node=None):
+    """cpu and mem_gb estimated from the resource history (None if there is no history),
+    node: the element used for the estimate (see estimated_node)
+    """
+    cache_dir = job.template.node.cache_dir
+    if cache_dir is None:
+        return None
+    if node is None:
+        node = estimated_node(job)
+    return resource_history(cache_dir).estimate(node)
+
+
+def estimated_node(job):
+    """node of the job used for the estimates,
+    the element with the largest inputs for a chunk (the elements are run one by one)
+    """
+    if isinstance(job, JobChunk):
+        nodes = [job.template.rehydrate(inputs) for inputs in job.inputs_list]
+        return max(nodes, key=lambda nn: size_class(nn.inputs))
+    return job.node
+
+
+def _total_memory_gb():
+    try:
+        from ..utils.profiler import get_system_total_memory_gb
+
+        return get_system_total_memory_gb()
+    except Exception:
+        logger.debug("total memory not available, memory is not limited")
+        return None
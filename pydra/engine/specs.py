@@ -1,6 +1,6 @@
 import dataclasses as dc
-from hashlib import sha256
 from pathlib import Path
+import threading
 import typing as ty
 
 File = ty.NewType("File", Path)
@@ -20,8 +20,10 @@ class BaseSpec:
 
     @property
     def hash(self):
-        """Compute a basic hash for any given set of fields"""
-        return sha256(str(self).encode()).hexdigest()
+        """Compute a hash for any given set of fields (files are hashed by content)"""
+        from .helpers_file import hash_spec
+
+        return hash_spec(self)
 
 
 @dc.dataclass
@@ -29,6 +31,7 @@ class Runtime:
     rss_peak_gb: ty.Optional[float] = None
     vms_peak_gb: ty.Optional[float] = None
     cpu_peak_percent: ty.Optional[float] = None
+    duration_sec: ty.Optional[float] = None
 
 
 @dc.dataclass
@@ -38,24 +41,74 @@ class Result:
 
     def __getstate__(self):
         state = self.__dict__.copy()
-        fields = tuple(state["output"].__annotations__.items())
-        state["output_spec"] = (state["output"].__class__.__name__, fields)
-        state["output"] = dc.asdict(state["output"])
+        if state["output"] is not None:
+            fields = tuple((f.name, f.type) for f in dc.fields(state["output"]))
+            state["output_spec"] = (state["output"].__class__.__name__, fields)
+            # shallow dictionary, values (e.g. arrays) are not copied as by dc.asdict
+            state["output"] = {
+                name: getattr(state["output"], name) for name, _ in fields
+            }
         return state
 
     def __setstate__(self, state):
-        spec = list(state["output_spec"])
-        del state["output_spec"]
-        klass = dc.make_dataclass(spec[0], list(spec[1]))
-        state["output"] = klass(**state["output"])
+        if "output_spec" in state:
+            klass = _output_klass(*state.pop("output_spec"))
+            state["output"] = klass(**state["output"])
         self.__dict__.update(state)
 
 
+# output classes created by Result.__setstate__, key: (name, fields)
+_output_klasses = {}
+_output_klasses_max = 1024
+_output_klasses_lock = threading.Lock()
+
+
+def _output_klass(name, fields):
+    """output class is created only once for the name and fields"""
+    try:
+        key = (name, fields)
+        hash(key)
+    except TypeError:
+        return dc.make_dataclass(name, list(fields))
+    # results are read in the threads of the workers
+    with _output_klasses_lock:
+        if key not in _output_klasses:
+            if len(_output_klasses) >= _output_klasses_max:
+                _output_klasses.pop(next(iter(_output_klasses)))
+            _output_klasses[key] = dc.make_dataclass(name, list(fields))
+        return _output_klasses[key]
+
+
+@dc.dataclass
+class CacheReport:
+    """state elements of a node that would be read from the cache (hits)
+    and that would run (misses), created by Submitter.dry_run
+    """
+
+    name: str
+    hits: ty.List = dc.field(default_factory=list)
+    misses: ty.List = dc.field(default_factory=list)
+    # inputs come from other nodes, so elements can be checked only after running them
+    waiting: bool = False
+    # expected duration of the misses (from the resource history),
+    # None if some of the elements haven't been run before
+    duration_sec: ty.Optional[float] = None
+
+    @property
+    def nr_elements(self):
+        return len(self.hits) + len(self.misses)
+
+
 @dc.dataclass
 class RuntimeSpec:
     outdir: ty.Optional[str] = None
     container: ty.Optional[str] = "shell"
     network: bool = False
+    # resources required by one state element (used by ResourceScheduler),
+    # cpu and mem_gb are estimated from the history of previous runs if not set
+    cpu: ty.Optional[int] = None
+    mem_gb: ty.Optional[float] = None
+    gpu: int = 0
     """
     from CWL:
     InlineJavascriptRequirement
@@ -1,3 +1,4 @@
+from collections.abc import Sequence
 from copy import deepcopy
 import pdb
 
@@ -10,11 +11,21 @@ from .specs import BaseSpec
 class State:
     def __init__(self, name, splitter=None, combiner=None, other_states=None):
         self.name = name
+        # array with state indices (if calculated by aux.splits_indices)
+        self.states_ind_array = None
+        self._ind_l = None
+        self._ind_l_final = None
+        if not other_states:
+            # splitter/combiner without other states are parsed only once
+            self.other_states = {}
+            self.inner_inputs = {}
+            self.compiled = compile_splitter(name, splitter, combiner)
+            self.compiled.apply(self)
+            return
+        self.compiled = None
         self.other_states = other_states
         self.splitter = splitter
         self.combiner = combiner
-        if not self.other_states:
-            self.other_states = {}
         self.inner_inputs = {"{}.{}".format(self.name, inp): st
                              for name, (st, inp) in self.other_states.items()}
         self.connect_splitters()
@@ -22,10 +33,42 @@ class State:
         self.set_splitter_final()
 
 
+    def __deepcopy__(self, memo):
+        """parsed splitter is shared with the copy"""
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        shared = CompiledSplitter.attributes if self.compiled else []
+        for key, val in self.__dict__.items():
+            new.__dict__[key] = val if key in shared else deepcopy(val, memo)
+        return new
+
+
     @property
     def splitter(self):
         return self._splitter
 
+    @property
+    def ind_l(self):
+        """list of tuples with state indices (tuples are created only when needed)"""
+        if self._ind_l is None and self.states_ind_array is not None:
+            self._ind_l = [tuple(ind) for ind in self.states_ind_array.tolist()]
+        return self._ind_l
+
+    @ind_l.setter
+    def ind_l(self, ind_l):
+        self._ind_l = ind_l
+
+    @property
+    def ind_l_final(self):
+        """list of tuples with state indices after combiner"""
+        if self._ind_l_final is None:
+            return self.ind_l
+        return self._ind_l_final
+
+    @ind_l_final.setter
+    def ind_l_final(self, ind_l_final):
+        self._ind_l_final = ind_l_final
+
     @splitter.setter
     def splitter(self, splitter):
         if splitter:
@@ -208,6 +251,12 @@ class State:
             keys_out = key_l + key_r
             self.val_l = val_l
             self.key_l = key_l
+        elif not self.other_states:
+            # no inputs from other states: all indices are calculated at once by numpy
+            self.states_ind_array, keys_out = aux.splits_indices(self.splitter_rpn, inputs)
+            values = None
+            self.key_l = []
+            self.val_l = []
         else:
             values_out, keys_out, _, _ = aux._splits(self.splitter_rpn, inputs,
                                                      inner_inputs=self.inner_inputs)
@@ -217,12 +266,16 @@ class State:
             self.val_l = []
         self.ind_l = values
         self.keys = keys_out
-        self.states_ind = list(aux.iter_splits(values, self.keys))
+        if values is None:
+            self.states_ind = StatesInd(self.states_ind_array, self.keys)
+        else:
+            self.states_ind_array = None
+            self.states_ind = list(aux.iter_splits(values, self.keys))
         self.keys_final = self.keys
         if self.combiner:
             self.prepare_states_combined_ind(inputs=inputs)
         else:
-            self.ind_l_final = self.ind_l
+            self.ind_l_final = None
             self.keys_final = self.keys
         return self.states_ind
 
@@ -267,10 +320,131 @@ class State:
         """evaluate states values having states indices"""
         if isinstance(inputs, BaseSpec):
             inputs = aux.inputs_types_to_dict(self.name, inputs)
-        self.states_val = list(aux.map_splits(self.states_ind, inputs))
+        self.states_val = StatesVal(self.states_ind, inputs, self.keys)
         return self.states_val
 
 
+# parsed splitters, key: (name, splitter, combiner)
+_compiled_splitters = {}
+_compiled_splitters_max = 256
+
+
+def compile_splitter(name, splitter, combiner=None):
+    """returns the parsed splitter for a state without other states,
+    it's created only once for every name, splitter and combiner
+    """
+    key = (name, repr(splitter), repr(combiner))
+    if key not in _compiled_splitters:
+        if len(_compiled_splitters) >= _compiled_splitters_max:
+            _compiled_splitters.pop(next(iter(_compiled_splitters)))
+        _compiled_splitters[key] = CompiledSplitter(name, deepcopy(splitter),
+                                                    deepcopy(combiner))
+    return _compiled_splitters[key]
+
+
+class CompiledSplitter:
+    """splitter and combiner of a state without other states after parsing
+    (rpn, final splitter, groups, keys, combiner_all),
+    the attributes are shared by all states with the same splitter and should not be changed
+    """
+    attributes = ["_splitter", "splitter_rpn", "splitter_rpn_nost", "splitter_final",
+                  "_combiner", "_left_splitter", "_left_splitter_rpn_nost",
+                  "_right_splitter", "_right_splitter_rpn", "_right_keys_final",
+                  "combiner_all", "_right_group_for_inputs_final",
+                  "_right_groups_stack_final", "group_for_inputs_final",
+                  "groups_stack_final", "keys_final", "splitter_rpn_final"]
+
+    def __init__(self, name, splitter, combiner=None):
+        # using methods of State to parse the splitter
+        st = State.__new__(State)
+        st.name = name
+        st.other_states = {}
+        st.inner_inputs = {}
+        st.splitter = splitter
+        st.combiner = combiner
+        st.connect_splitters()
+        st.set_input_groups()
+        st.set_splitter_final()
+        for attr in self.attributes:
+            setattr(self, attr, getattr(st, attr))
+
+    def apply(self, state):
+        """setting the parsed attributes in the state"""
+        for attr in self.attributes:
+            setattr(state, attr, getattr(self, attr))
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class StatesInd(Sequence):
+    """view of the array with state indices, returns dictionaries with indices
+    (states without other states, the indices of merged states are in a list)
+    """
+    def __init__(self, ind_array, keys):
+        self.ind_array = ind_array
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.ind_array)
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return [self[i] for i in range(*ind.indices(len(self)))]
+        return dict(zip(self.keys, self.ind_array[_state_index(ind, len(self))].tolist()))
+
+    def __eq__(self, other):
+        return _states_eq(self, other)
+
+    def __repr__(self):
+        return "StatesInd(len={})".format(len(self))
+
+
+class StatesVal(Sequence):
+    """view of the state values, returns dictionaries with values
+    taken from the flattened inputs (inputs are flattened only once)
+    """
+    def __init__(self, states_ind, inputs, keys):
+        self.states_ind = states_ind
+        self.keys = keys
+        self.inputs_flat = {key: list(aux.flatten(aux.ensure_list(inputs[key])))
+                            for key in keys}
+
+    def __len__(self):
+        return len(self.states_ind)
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return [self[i] for i in range(*ind.indices(len(self)))]
+        ind = _state_index(ind, len(self))
+        if isinstance(self.states_ind, StatesInd):
+            ind_el = self.states_ind.ind_array[ind].tolist()
+            return {key: self.inputs_flat[key][i] for key, i in zip(self.keys, ind_el)}
+        return {key: self.inputs_flat[key][i] for key, i in self.states_ind[ind].items()}
+
+    def __eq__(self, other):
+        return _states_eq(self, other)
+
+    def __repr__(self):
+        return "StatesVal(len={})".format(len(self))
+
+
+def _state_index(ind, length):
+    """non-negative index of the state element"""
+    if ind < 0:
+        ind += length
+    if not 0 <= ind < length:
+        raise IndexError("state index out of range")
+    return ind
+
+
+def _states_eq(states, other):
+    """views are equal to lists with the same elements"""
+    if len(states) != len(other):
+        return False
+    return all(el == el_other for el, el_other in zip(states, other))
+
+
 '''    
     def cross_combine(self, other):
         self.ndim += other.ndim
@@ -1,9 +1,26 @@
 import os, time, pdb
+import asyncio
+import concurrent.futures as cf
+import queue
 from copy import deepcopy
 import dataclasses as dc
+from functools import partial
 
-from .workers import MpWorker, SerialWorker, DaskWorker, ConcurrentFuturesWorker
-from .node import NodeBase
+from .workers import (
+    MpWorker,
+    SerialWorker,
+    DaskWorker,
+    ConcurrentFuturesWorker,
+    ThreadWorker,
+    WarmPoolWorker,
+    AsyncWorker,
+)
+from .node import NodeBase, JobChunk, is_workflow
+from .cache import CacheManager
+from .history import resource_history, size_class, task_type
+from .scheduler import ResourceScheduler, critical_path
+from .specs import CacheReport
+from ..utils.messenger import gen_uuid
 
 import logging
 
@@ -12,20 +29,68 @@ logger = logging.getLogger("pydra.workflow")
 
 class Submitter(object):
     # TODO: runnable in init or run
-    def __init__(self, plugin):
+    def __init__(
+        self, plugin, chunksize=None, cache_only=False, resources=None, **kwargs
+    ):
+        """
+        chunksize: number of state elements of a node that are sent to the worker
+            as one job, "auto" sets it from the number of elements and processes,
+            (every element is a separate job if None)
+        cache_only: results are only read from the cache, nothing is run
+            (exception is raised if any result is missing)
+        resources: dictionary with capacity (cpu, mem_gb, gpu) for the ResourceScheduler,
+            elements are submitted only if the resources required by the task are free
+            (used by default for mp, warm, cf and threads, with the number of processes
+            and total memory)
+        kwargs are passed to the worker, e.g. nr_proc
+        """
         self.plugin = plugin
-        self.node_line = []
-        self._to_finish = []  # used only for wf
+        self.chunksize = chunksize
+        self.cache_only = cache_only
+        # elements that wait for inputs from other nodes
+        # (key: node or inner workflow, value: set of state indices)
+        self.node_line = {}
+        # number of unfinished upstream elements for every waiting element, key: (node, ind)
+        self._pending = {}
+        # waiting elements that use outputs of the upstream element, key: (node, ind)
+        self._dependents = {}
+        # elements reported back as finished
+        self._finished = set()
+        # critical path priorities of the nodes, ready elements with higher priority run first
+        self._priority = {}
+        # expected durations of the elements, key: (task type, size class, cache_dir)
+        self._durations = {}
+        # templates of the nodes (with the inputs used for the template),
+        # shared by the jobs of all elements of the node
+        self._templates = {}
+        # elements reported as finished by the workers (filled by future callbacks)
+        self._completed = queue.Queue()
+        # number of elements submitted to the worker and not reported back yet
+        self._in_flight = 0
+        # results pinned in the cache till the submitter is closed
+        # (the token is in the pins of this submitter, other submitters have their own)
+        self._pinned = []
+        self._pin_token = gen_uuid()
         if self.plugin == "mp":
-            self.worker = MpWorker()
+            self.worker = MpWorker(**kwargs)
         elif self.plugin == "serial":
-            self.worker = SerialWorker()
+            self.worker = SerialWorker(**kwargs)
         elif self.plugin == "dask":
-            self.worker = DaskWorker()
+            self.worker = DaskWorker(**kwargs)
         elif self.plugin == "cf":
-            self.worker = ConcurrentFuturesWorker()
+            self.worker = ConcurrentFuturesWorker(**kwargs)
+        elif self.plugin == "warm":
+            self.worker = WarmPoolWorker(**kwargs)
+        elif self.plugin == "threads":
+            self.worker = ThreadWorker(**kwargs)
+        elif self.plugin == "async":
+            self.worker = AsyncWorker(**kwargs)
         else:
             raise Exception("plugin {} not available".format(self.plugin))
+        if resources is not None or self.plugin in ["mp", "warm", "cf", "threads"]:
+            self.scheduler = ResourceScheduler(self.worker, **(resources or {}))
+        else:
+            self.scheduler = None
 
     def __enter__(self):
         return self
@@ -37,19 +102,66 @@ class Submitter(object):
         """main running method, checks if submitter id for Node or Workflow"""
         if not isinstance(runnable, NodeBase):  # a node/workflow
             raise Exception("runnable has to be a Node or Workflow")
-        if runnable.state:
-            runnable.state.prepare_states(runnable.inputs)
-        futures = []
-        if runnable.state:
-            for ii, ind in enumerate(runnable.state.states_val):
-                res = self.worker.run_el(runnable.to_job(ii))
-                futures.append([ii, res])
-        else:
-            res = self.worker.run_el(runnable.to_job(None))
-            futures.append([None, res])
-        for ind, task_future in futures:
+        if is_workflow(runnable):
+            self.workflow = runnable
+            return self.run_workflow()
+        inds = self._node_inds(runnable)
+        futures = self._submit_jobs(runnable, inds)
+        for ind, task_future in zip(inds, futures):
             runnable.results_dict[ind] = task_future
 
+    def dry_run(self, runnable):
+        """checking which state elements would be read from the cache and which would run,
+        nothing is executed and the cache is not changed;
+        returns a CacheReport for every node (with the expected duration of the misses)
+        """
+        if not isinstance(runnable, NodeBase):  # a node/workflow
+            raise Exception("runnable has to be a Node or Workflow")
+        if is_workflow(runnable):
+            nodes = runnable.graph_sorted
+        else:
+            nodes = [runnable]
+        reports = {}
+        for node in nodes:
+            report = CacheReport(name=node.name)
+            if is_workflow(node) or node.needed_outputs:
+                report.waiting = True
+            else:
+                template = node.job_template()
+                durations = []
+                for ind in self._node_inds(node):
+                    el = template.rehydrate(node._job_inputs(ind))
+                    if el._cached_result(mark_used=False) is None:
+                        report.misses.append(ind)
+                        durations.append(self._history_duration(el))
+                    else:
+                        report.hits.append(ind)
+                if None not in durations:
+                    report.duration_sec = sum(durations)
+            reports[node.name] = report
+        return reports
+
+    async def run_async(self, runnable):
+        """running all elements of the node concurrently in the running event loop,
+        e.g. ``await submitter.run_async(node)``
+        """
+        if not isinstance(runnable, NodeBase) or is_workflow(runnable):
+            raise Exception("runnable has to be a Node")
+        inds = self._node_inds(runnable)
+        if self.cache_only:
+            for ind, future in zip(inds, self._cached_futures(runnable, inds)):
+                runnable.results_dict[ind] = future
+            return
+        futures = []
+        template = runnable.job_template()
+        for ind in inds:
+            future = asyncio.ensure_future(
+                self.worker.run_el_async(runnable.to_job(ind, template=template))
+            )
+            runnable.results_dict[ind] = future
+            futures.append(future)
+        await asyncio.gather(*futures)
+
     def run_workflow(self, workflow=None, ready=True):
         """the main function to run Workflow"""
         if not workflow:
@@ -63,33 +175,25 @@ class Submitter(object):
             for ind in workflow.state.index_generator:
                 new_workflow = deepcopy(workflow)
                 new_workflow.parent_wf = workflow
+                self._priority[new_workflow] = self._priority.get(workflow, 0)
                 # adding all nodes to the parent workflow
                 for (i_n, node) in enumerate(new_workflow.graph_sorted):
                     workflow.inner_nodes[node.name].append(node)
                 if ready:
                     self._run_workflow_el(new_workflow, ind)
                 else:
-                    self.node_line.append((new_workflow, ind))
+                    self._add_to_line(new_workflow, ind)
         else:
             if ready:
                 workflow.preparing(wf_inputs=workflow.inputs)
                 self._run_workflow_nd(workflow=workflow)
             else:
-                self.node_line.append((workflow, ()))
+                self._add_to_line(workflow, ())
 
-        # this parts submits nodes that are waiting to be run
-        # it should stop when nothing is waiting
-        while self._nodes_check():
-            logger.debug("Submitter, in while, node_line: {}".format(self.node_line))
-            time.sleep(3)
-
-        # this part simply waiting for all "last nodes" to finish
-        while self._output_check():
-            logger.debug("Submitter, in while, to_finish: {}".format(self._to_finish))
-            time.sleep(3)
-
-        # calling only for the main wf (other wf will be called inside the function)
+        # only the main wf waits for the results,
+        # inner workflows are driven by the same completion loop
         if workflow is self.workflow:
+            self._wait_for_completion()
             workflow.get_output()
 
     def _run_workflow_el(self, workflow, ind, collect_inp=False):
@@ -104,67 +208,288 @@ class Submitter(object):
         self._run_workflow_nd(workflow=workflow)
 
     def _run_workflow_nd(self, workflow):
-        """iterating over all nodes from a workflow and submitting them or adding to the node_line"""
-        for (i_n, node) in enumerate(workflow.graph_sorted):
+        """submitting the elements from a workflow that have all inputs
+        (highest critical path priority first, so the critical path starts first),
+        other elements are submitted with the upstream futures or added to the node_line
+        """
+        self._set_priorities(workflow)
+        for node in workflow.graph_sorted:
             node.prepare_state_input()
-            self._to_finish.append(node)
-            # submitting all the nodes who are self sufficient (self.workflow.graph is already sorted)
-            if node.ready2run:
-                if hasattr(node, "interface"):
-                    self._submit_node(node)
-                else:  # it's workflow
+        nodes = sorted(
+            workflow.graph_sorted,
+            key=lambda nn: self._priority.get(nn, 0),
+            reverse=True,
+        )
+        waiting = []
+        for node in nodes:
+            if is_workflow(node):
+                # inner workflows start when all inputs are available
+                if node.ready2run():
                     self.run_workflow(workflow=node)
-            # if its not, its been added to a line
+                else:
+                    waiting.append((node, None))
+            elif not node.needed_outputs:
+                self._submit_node(node)
             else:
-                break
-            # in case there is no element in the graph that goes to the break
-            # i want to be sure that not calculating the last node again in the next for loop
-            if i_n == len(workflow.graph_sorted) - 1:
-                i_n += 1
-
-        # all nodes that are not self sufficient (not ready to run) will go to the line
-        # iterating over all elements
-        for nn in list(workflow.graph_sorted)[i_n:]:
-            if hasattr(nn, "interface"):
-                for ind in nn.state.index_generator:
-                    self._to_finish.append(nn)
-                    self.node_line.append((nn, ind))
-            else:  # wf
-                self.run_workflow(workflow=nn, ready=False)
-
-    def _nodes_check(self):
-        """checking which nodes-states are ready to run and running the ones that are ready"""
-        _to_remove = []
-        for (to_node, ind) in self.node_line:
-            if hasattr(to_node, "interface"):
-                print(
-                    "_NODES_CHECK INPUT", to_node.name, to_node.checking_input_el(ind)
+                # elements start as soon as the upstream elements they use are finished
+                inds = list(node.state.index_generator) if node.state else [None]
+                for ind in inds:
+                    if node.ready2run(ind):
+                        self._submit_node_el(node, ind)
+                    else:
+                        waiting.append((node, ind))
+        # in the graph order, so the futures of the upstream elements are known
+        order = {node: i for i, node in enumerate(workflow.graph_sorted)}
+        waiting.sort(key=lambda el: order[el[0]])
+        for node, ind in waiting:
+            if is_workflow(node):
+                self.run_workflow(workflow=node, ready=False)
+            elif not self._submit_graph_el(node, ind):
+                self._add_to_line(node, ind)
+
+    def _set_priorities(self, workflow):
+        """critical path priorities of the nodes (durations from the resource history),
+        priorities of inner workflows nodes include the path after the inner workflow
+        """
+        durations = {nn: self._duration(nn) for nn in workflow.graph_sorted}
+        offset = self._priority.get(workflow, 0)
+        for nn, priority in critical_path(workflow.graph, durations).items():
+            self._priority[nn] = priority + offset
+
+    def _duration(self, node):
+        """expected duration of one element of the node in seconds
+        (the history is not read again, e.g. for every copy of an inner workflow)
+        """
+        if is_workflow(node):
+            # included in the priorities of the inner nodes
+            return 0
+        duration = self._history_duration(node)
+        return 1.0 if duration is None else duration
+
+    def _history_duration(self, node):
+        """duration of one element from the resource history (None if it's not known),
+        read once for the task type and the size of the inputs
+        """
+        if node.cache_dir is None:
+            return None
+        key = (task_type(node), size_class(node.inputs), node.cache_dir)
+        if key not in self._durations:
+            self._durations[key] = resource_history(node.cache_dir).duration(node)
+        return self._durations[key]
+
+    def _add_to_line(self, node, ind):
+        """adding a state element that waits for inputs from other nodes,
+        it's counted as a dependent of every upstream element that is not finished
+        (the element is run if all upstream elements are already finished)
+        """
+        pending = [el for el in node.upstream_elements(ind) if el not in self._finished]
+        if not pending:
+            self._run_ready_el(node, ind)
+            return
+        self.node_line.setdefault(node, set()).add(ind)
+        for element in pending:
+            self._dependents.setdefault(element, []).append((node, ind))
+        self._pending[(node, ind)] = len(pending)
+
+    def _submit_node(self, node):
+        """submitting all state elements of a node that has all inputs"""
+        inds = self._node_inds(node)
+        for ind, future in zip(inds, self._submit_jobs(node, inds)):
+            self._register_future(node, ind, future)
+
+    def _submit_node_el(self, node, ind):
+        """submitting one state element, the future reports back when it's finished"""
+        self._register_future(node, ind, self._submit_jobs(node, [ind])[0])
+
+    def _submit_graph_el(self, node, ind):
+        """submitting the element together with the futures of the upstream elements
+        (workers that handle the dependencies, e.g. dask), returns False if it's not possible
+        """
+        if self.cache_only or not hasattr(self.worker, "run_el_graph"):
+            return False
+        outputs = node.upstream_outputs(ind)
+        if outputs is None:
+            return False
+        upstream = {}
+        for from_node, from_ind, from_socket, to_socket in outputs:
+            if from_ind not in from_node.results_dict:
+                return False
+            upstream[to_socket] = (from_node.results_dict[from_ind], from_socket)
+        # checksum is not known before the upstream results, so the result is not pinned
+        job = node.to_job(ind, template=self._job_template(node), connected=False)
+        future = self.worker.run_el_graph(job, upstream)
+        if future is None:
+            return False
+        self._register_future(node, ind, future)
+        return True
+
+    def _node_inds(self, node):
+        """preparing the state and returning indices of all state elements"""
+        if node.state:
+            node.state.prepare_states(node.inputs)
+            return list(range(len(node.state.states_val)))
+        return [None]
+
+    def _submit_jobs(self, node, inds):
+        """submitting elements of the node to the worker (in chunks if chunksize is set),
+        returns a future for every element
+        """
+        if self.cache_only:
+            return self._cached_futures(node, inds)
+        chunksize = self._chunksize(len(inds))
+        # the node is copied (and pickled) only once for all jobs
+        template = self._job_template(node)
+        jobs = [node.to_job(ind, template=template) for ind in inds]
+        self._pin(jobs)
+        priority = self._priority.get(node, 0)
+        if chunksize == 1:
+            return [self._run_el(job, priority) for job in jobs]
+        futures = []
+        for i in range(0, len(inds), chunksize):
+            chunk = jobs[i : i + chunksize]
+            chunk_future = self._run_el(
+                JobChunk(
+                    template,
+                    [job.inputs for job in chunk],
+                    [job._checksum for job in chunk],
+                ),
+                priority,
+            )
+            el_futures = [cf.Future() for _ in chunk]
+            for future in el_futures:
+                future.set_running_or_notify_cancel()
+            chunk_future.add_done_callback(
+                partial(_set_chunk_results, el_futures=el_futures)
+            )
+            futures += el_futures
+        return futures
+
+    def _job_template(self, node):
+        """template of the node, created once for all elements
+        (a new one if the inputs of the node are changed)
+        """
+        inputs, template = self._templates.get(node, (None, None))
+        if inputs is not node.inputs:
+            template = node.job_template()
+            self._templates[node] = (node.inputs, template)
+        return template
+
+    def _run_el(self, job, priority=0):
+        """submitting the job to the worker (through the scheduler if it's used)"""
+        if self.scheduler is not None:
+            return self.scheduler.submit(job, priority)
+        return self.worker.run_el(job)
+
+    def _cached_results(self, node, inds):
+        """results of the elements from the cache (None if the result is missing)"""
+        template = node.job_template()
+        return [
+            template.rehydrate(node._job_inputs(ind))._cached_result() for ind in inds
+        ]
+
+    def _cached_futures(self, node, inds):
+        """finished futures with results from the cache (cache_only mode)"""
+        results = self._cached_results(node, inds)
+        missing = [ind for ind, result in zip(inds, results) if result is None]
+        if missing:
+            raise Exception(
+                "cache_only: results of {} are not in the cache, "
+                "state indices: {}".format(node.name, missing)
+            )
+        futures = []
+        for result in results:
+            future = cf.Future()
+            future.set_result(result)
+            futures.append(future)
+        return futures
+
+    def _pin(self, jobs):
+        """results used by the submitter are not removed from the cache by CacheManager"""
+        for job in jobs:
+            if job.cache_dir is not None:
+                manager = CacheManager(job.cache_dir)
+                manager.pin(job.checksum, self._pin_token)
+                self._pinned.append((manager, job.checksum))
+
+    def _chunksize(self, nr_el):
+        """number of elements in one job"""
+        if not self.chunksize or nr_el == 1:
+            return 1
+        if self.chunksize == "auto":
+            # similar to multiprocessing.Pool.map: ~4 chunks per process
+            chunksize, extra = divmod(nr_el, getattr(self.worker, "nr_proc", 1) * 4)
+            return max(chunksize + bool(extra), 1)
+        return self.chunksize
+
+    def _register_future(self, node, ind, future):
+        """saving the future of the element, it reports back when it's finished"""
+        node.results_dict[ind] = future
+        self._in_flight += 1
+        future.add_done_callback(
+            lambda _, node=node, ind=ind: self._completed.put((node, ind))
+        )
+
+    def _wait_for_completion(self):
+        """waiting for elements reported by the workers as finished
+        and submitting the waiting elements that became ready
+        """
+        while self._in_flight:
+            node, ind = self._completed.get()
+            self._in_flight -= 1
+            logger.debug("Submitter, finished: {}, {}".format(node.name, ind))
+            self._element_finished(node, ind)
+        if self.node_line:
+            raise Exception(
+                "nothing is running, but inputs are missing for: {}".format(
+                    [node.name for node in self.node_line]
                 )
-                if to_node.checking_input_el(ind):
-                    self._submit_node_el(to_node, ind)
-                    _to_remove.append((to_node, ind))
-            else:  # wf
-                if to_node.checking_input_el(ind):
-                    self._run_workflow_el(workflow=to_node, ind=ind, collect_inp=True)
-                    _to_remove.append((to_node, ind))
-                else:
-                    pass
-
-        for rn in _to_remove:
-            self.node_line.remove(rn)
-        return self.node_line
-
-    # this I believe can be done for entire node
-    def _output_check(self):
-        """"checking if all nodes are done"""
-        _to_remove = []
-        for node in self._to_finish:
-            print("_output check node", node, node.name, node.done)
-            if node.done:
-                _to_remove.append(node)
-        for rn in _to_remove:
-            self._to_finish.remove(rn)
-        return self._to_finish
+            )
+
+    def _element_finished(self, node, ind):
+        """updating the counters of the waiting elements that use the finished element
+        and running the elements that have all inputs (highest priority first)
+        """
+        self._finished.add((node, ind))
+        ready = []
+        for element in self._dependents.pop((node, ind), []):
+            self._pending[element] -= 1
+            if not self._pending[element]:
+                del self._pending[element]
+                ready.append(element)
+        ready.sort(key=lambda el: self._priority.get(el[0], 0), reverse=True)
+        for to_node, to_ind in ready:
+            waiting = self.node_line[to_node]
+            waiting.discard(to_ind)
+            if not waiting:
+                del self.node_line[to_node]
+            self._run_ready_el(to_node, to_ind)
+
+    def _run_ready_el(self, node, ind):
+        """running the element that has all inputs from the upstream elements"""
+        if is_workflow(node):
+            self._run_workflow_el(workflow=node, ind=ind, collect_inp=True)
+        else:
+            self._submit_node_el(node, ind)
 
     def close(self):
+        if self.scheduler is not None:
+            # waiting jobs are still submitted to the worker
+            self.scheduler.wait()
         self.worker.close()
+        for manager, checksum in self._pinned:
+            manager.unpin(checksum, self._pin_token)
+        self._pinned = []
+        self._templates = {}
+
+
+def _set_chunk_results(chunk_future, el_futures):
+    """passing results (or exceptions) from the job with a chunk to the elements"""
+    try:
+        results = chunk_future.result()
+    except Exception as e:
+        results = [e] * len(el_futures)
+    for future, result in zip(el_futures, results):
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
@@ -36,8 +36,10 @@ Original file is located at
 """
 
 
+import asyncio
 import cloudpickle as cp
 import dataclasses as dc
+from functools import lru_cache
 import inspect
 import typing as ty
 
@@ -52,7 +54,7 @@ from .specs import (
     DockerSpec,
     SingularitySpec,
 )
-from .helpers import ensure_list, execute
+from .helpers import ensure_list, execute, execute_async
 
 
 class FunctionTask(NodeBase):
@@ -65,6 +67,7 @@ class FunctionTask(NodeBase):
         messengers=None,
         messenger_args=None,
         cache_dir=None,
+        cache_locations=None,
         **kwargs
     ):
         self.input_spec = SpecInfo(
@@ -87,6 +90,7 @@ class FunctionTask(NodeBase):
             messengers=messengers,
             messenger_args=messenger_args,
             cache_dir=cache_dir,
+            cache_locations=cache_locations,
         )
         if output_spec is None:
             if "return" not in func.__annotations__:
@@ -124,10 +128,32 @@ class FunctionTask(NodeBase):
         self.set_output_keys()
 
     def _run_task(self):
-        inputs = dc.asdict(self.inputs)
-        del inputs["_func"]
+        # inputs are not copied (dc.asdict makes deep copies)
+        inputs = {
+            f.name: getattr(self.inputs, f.name)
+            for f in dc.fields(self.inputs)
+            if f.name != "_func"
+        }
         self.output_ = None
-        output = cp.loads(self.inputs._func)(**inputs)
+        output = load_function(self.inputs._func)(**inputs)
+        if inspect.isawaitable(output):
+            # coroutine function run outside of an event loop
+            output = asyncio.run(output)
+        self._set_output(output)
+
+    async def _run_task_async(self):
+        inputs = {
+            f.name: getattr(self.inputs, f.name)
+            for f in dc.fields(self.inputs)
+            if f.name != "_func"
+        }
+        self.output_ = None
+        output = load_function(self.inputs._func)(**inputs)
+        if inspect.isawaitable(output):
+            output = await output
+        self._set_output(output)
+
+    def _set_output(self, output):
         if not isinstance(output, tuple):
             output = (output,)
         self.output_ = list(output)
@@ -136,6 +162,12 @@ class FunctionTask(NodeBase):
         return self.output_
 
 
+@lru_cache(maxsize=128)
+def load_function(func_pickled):
+    """unpickling the function once per process (jobs of a node share the function)"""
+    return cp.loads(func_pickled)
+
+
 def to_task(func_to_decorate):
     def create_func(**original_kwargs):
         function_task = FunctionTask(func=func_to_decorate, **original_kwargs)
@@ -154,6 +186,7 @@ class ShellCommandTask(NodeBase):
         messengers=None,
         messenger_args=None,
         cache_dir=None,
+        cache_locations=None,
         **kwargs
     ):
         if input_spec is None:
@@ -169,6 +202,7 @@ class ShellCommandTask(NodeBase):
             messengers=messengers,
             messenger_args=messenger_args,
             cache_dir=cache_dir,
+            cache_locations=cache_locations,
         )
         if output_spec is None:
             output_spec = SpecInfo(name="Output", fields=[], bases=(ShellOutSpec,))
@@ -199,6 +233,12 @@ class ShellCommandTask(NodeBase):
         if args:
             self.output_ = execute(args)
 
+    async def _run_task_async(self):
+        self.output_ = None
+        args = self.command_args
+        if args:
+            self.output_ = await execute_async(args, cwd=self.output_dir)
+
     def _list_outputs(self):
         return list(self.output_)
 
@@ -213,6 +253,7 @@ class ContainerTask(ShellCommandTask):
         messengers=None,
         messenger_args=None,
         cache_dir=None,
+        cache_locations=None,
         **kwargs
     ):
 
@@ -228,6 +269,7 @@ class ContainerTask(ShellCommandTask):
             messengers=messengers,
             messenger_args=messenger_args,
             cache_dir=cache_dir,
+            cache_locations=cache_locations,
             **kwargs
         )
 
@@ -266,6 +308,12 @@ class ContainerTask(ShellCommandTask):
         if args:
             self.output_ = execute(args)
 
+    async def _run_task_async(self):
+        self.output_ = None
+        args = self.container_args + self.command_args
+        if args:
+            self.output_ = await execute_async(args, cwd=self.output_dir)
+
 
 class DockerTask(ContainerTask):
     def __init__(
@@ -277,6 +325,7 @@ class DockerTask(ContainerTask):
         messengers=None,
         messenger_args=None,
         cache_dir=None,
+        cache_locations=None,
         **kwargs
     ):
         if input_spec is None:
@@ -291,6 +340,7 @@ class DockerTask(ContainerTask):
             messengers=messengers,
             messenger_args=messenger_args,
             cache_dir=cache_dir,
+            cache_locations=cache_locations,
             **kwargs
         )
 
@@ -314,6 +364,7 @@ class SingularityTask(ContainerTask):
         messengers=None,
         messenger_args=None,
         cache_dir=None,
+        cache_locations=None,
         **kwargs
     ):
         if input_spec is None:
@@ -329,6 +380,7 @@ class SingularityTask(ContainerTask):
             messengers=messengers,
             messenger_args=messenger_args,
             cache_dir=cache_dir,
+            cache_locations=cache_locations,
             **kwargs
         )
 
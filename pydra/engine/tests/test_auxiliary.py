@@ -289,6 +289,30 @@ def test_splits_1e(splitter, values, keys, splits):
     assert splits_out == splits
 
 
+@pytest.mark.parametrize("splitter", [
+    "a", ("a", "v"), ["a", "v"], [("a", "v"), "c"], ["c", ("a", "v")],
+    (["a", "v"], "x"), ("x", ["a", "v"]), [["a", "v"], ["c", "z"]],
+    [("a", "v"), ("c", "z")], ["a", ["v", "c"]],
+])
+def test_splits_indices(splitter):
+    """indices from numpy are the same as from _splits"""
+    inputs = {"a": [1, 2], "v": ['a', 'b'], "c": [3, 4, 5], "z": [7, 8, 9],
+              "x": [[10, 100], [20, 200]]}
+    splitter_rpn = aux.splitter2rpn(splitter)
+    values_out, keys_out, _, _ = aux._splits(splitter_rpn, inputs)
+    ind_array, keys = aux.splits_indices(splitter_rpn, inputs)
+    assert keys == keys_out
+    assert ind_array.shape == (len(ind_array), len(keys))
+    assert [dict(zip(keys, ind)) for ind in ind_array.tolist()] == \
+        list(aux.iter_splits(list(values_out), keys_out))
+
+
+def test_splits_indices_mismatch():
+    splitter_rpn = aux.splitter2rpn((["a", "v"], "c"))
+    with pytest.raises(ValueError):
+        aux.splits_indices(splitter_rpn, {"a": [1, 2], "v": ["a", "b"], "c": [3, 4]})
+
+
 @pytest.mark.parametrize("splitter_rpn, inner_inputs, values, keys, splits", [
     # (["NA.a", "NA.b", "*"],
     #  {"c": other_splitters_to_tests(splitter=["NA.a", "NA.b"], keys_final=["NA.a", "NA.b"],
@@ -0,0 +1,109 @@
+import os
+import socket
+import time
+
+from filelock import FileLock
+
+from ..cache import PINS_DIR, CacheManager
+from ..submitter import Submitter
+from ..task import to_task
+
+
+@to_task
+def fun_addtwo(a):
+    return a + 2
+
+
+def _make_entry(cache_dir, name, size, age=0):
+    entry = cache_dir.mkdir(name)
+    entry.join("_result.pklz").write("x" * size)
+    last_used = time.time() - age
+    os.utime(entry, (last_used, last_used))
+    return entry
+
+
+def test_cache_gc_size(tmpdir):
+    """the least recently used results are removed"""
+    _make_entry(tmpdir, "Task_1", 1000, age=30)
+    _make_entry(tmpdir, "Task_2", 1000, age=20)
+    _make_entry(tmpdir, "Task_3", 1000, age=10)
+    manager = CacheManager(tmpdir, max_size_gb=2500 / 1024**3)
+    assert [path.name for path, _, _ in manager.entries()] == [
+        "Task_1",
+        "Task_2",
+        "Task_3",
+    ]
+    assert [path.name for path in manager.gc()] == ["Task_1"]
+    assert sorted(path.basename for path in tmpdir.listdir(lambda p: p.isdir())) == [
+        "Task_2",
+        "Task_3",
+    ]
+
+
+def test_cache_gc_age(tmpdir):
+    _make_entry(tmpdir, "Task_1", 10, age=3 * 24 * 3600)
+    _make_entry(tmpdir, "Task_2", 10, age=10)
+    manager = CacheManager(tmpdir, max_age_days=1)
+    assert [path.name for path in manager.gc()] == ["Task_1"]
+
+
+def test_cache_gc_pinned_locked(tmpdir):
+    """pinned results and results of running tasks are not removed"""
+    _make_entry(tmpdir, "Task_1", 10, age=30)
+    _make_entry(tmpdir, "Task_2", 10, age=20)
+    _make_entry(tmpdir, "Task_3", 10, age=10)
+    manager = CacheManager(tmpdir, max_size_gb=0)
+    manager.pin("Task_1", "token")
+    with FileLock(str(tmpdir.join("Task_2.lock"))):
+        assert [path.name for path in manager.gc()] == ["Task_3"]
+    manager.unpin("Task_1", "token")
+    assert [path.name for path in manager.gc()] == ["Task_1", "Task_2"]
+
+
+def test_cache_pins_hosts(tmpdir):
+    """pins of finished processes are removed only if they are from the current host"""
+    pins_dir = tmpdir.mkdir(PINS_DIR)
+    pid = 2**22 + 1  # larger than pid_max
+    pins_dir.join("Task_1.token.{}.{}".format(socket.gethostname(), pid)).write("")
+    pins_dir.join("Task_2.token.node2.cluster.org.{}".format(pid)).write("")
+    manager = CacheManager(tmpdir)
+    assert manager.pinned() == {"Task_2"}
+    assert [pin.basename for pin in pins_dir.listdir()] == [
+        "Task_2.token.node2.cluster.org.{}".format(pid)
+    ]
+
+
+def test_cache_touch(tmpdir):
+    """result used from the cache is the most recently used"""
+    nn = fun_addtwo(a=3, cache_dir=tmpdir)
+    nn.run()
+    os.utime(nn.output_dir, (0, 0))
+    nn.run()
+    assert time.time() - nn.output_dir.stat().st_mtime < 60
+
+
+def test_submitter_pins(tmpdir):
+    """results used by the submitter are pinned till it's closed"""
+    nn = fun_addtwo(name="NA", cache_dir=tmpdir).split(splitter="a", a=[1, 2])
+    manager = CacheManager(tmpdir, max_size_gb=0)
+    with Submitter(plugin="serial") as sub:
+        sub.run(nn)
+        assert len(manager.pinned()) == 2
+        assert manager.gc() == []
+    assert manager.pinned() == set()
+    assert len(manager.gc()) == 2
+
+
+def test_submitters_pins(tmpdir):
+    """result used by two submitters is pinned till both are closed"""
+    nn = fun_addtwo(name="NA", cache_dir=tmpdir).split(splitter="a", a=[1, 2])
+    manager = CacheManager(tmpdir, max_size_gb=0)
+    sub_1 = Submitter(plugin="serial")
+    sub_2 = Submitter(plugin="serial")
+    sub_1.run(nn)
+    sub_2.run(nn)
+    sub_1.close()
+    assert len(manager.pinned()) == 2
+    assert manager.gc() == []
+    sub_2.close()
+    assert manager.pinned() == set()
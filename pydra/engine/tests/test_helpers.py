@@ -0,0 +1,115 @@
+import dataclasses as dc
+from pathlib import Path
+
+import cloudpickle as cp
+import numpy as np
+import pytest
+
+from .. import helpers
+from ..helpers import save_result, read_result
+from ..specs import Result, Runtime
+
+
+def _result(out):
+    Output = dc.make_dataclass("Output", [("out", object), ("nr", int)])
+    return Result(output=Output(out=out, nr=3), runtime=Runtime(rss_peak_gb=1.0))
+
+
+@pytest.mark.parametrize("format", list(helpers.result_formats))
+def test_save_result(tmpdir, format):
+    arr = np.arange(100000.0).reshape(1000, 100)
+    save_result(Path(tmpdir), _result({"arr": arr, "small": [1, 2]}), format=format)
+    result = read_result(Path(tmpdir) / "_result.pklz")
+    assert result.output.nr == 3
+    assert result.output.out["small"] == [1, 2]
+    assert np.array_equal(result.output.out["arr"], arr)
+    assert result.runtime.rss_peak_gb == 1.0
+
+
+def test_save_result_buffers(tmpdir):
+    """large arrays are saved out-of-band and memory-mapped when the result is read"""
+    if helpers.RESULT_FORMAT != "buffers":
+        pytest.skip("requires pickle protocol 5")
+    arr = np.arange(100000.0)
+    save_result(Path(tmpdir), _result(arr))
+    assert tmpdir.join("_result.buffers").size() >= arr.nbytes
+    assert tmpdir.join("_result.pklz").size() < 10000
+    out = read_result(Path(tmpdir) / "_result.pklz").output.out
+    assert np.array_equal(out, arr)
+    assert not out.flags.writeable
+
+
+def test_read_result_cloudpickle(tmpdir):
+    """results saved without the header (older format)"""
+    tmpdir.join("_result.pklz").write_binary(cp.dumps(_result(5)))
+    assert read_result(Path(tmpdir) / "_result.pklz").output.out == 5
+
+
+def test_result_no_output():
+    """results of failed runs have no output"""
+    result = cp.loads(cp.dumps(Result(output=None)))
+    assert result.output is None
+
+
+def test_result_klass():
+    """output class is created once when many results are loaded"""
+    result_1 = cp.loads(cp.dumps(_result(1)))
+    result_2 = cp.loads(cp.dumps(_result(2)))
+    assert type(result_1.output) is type(result_2.output)
+
+
+def test_mapped_array(tmpdir):
+    """arrays from the result are pickled as handles to the memory-mapped file"""
+    arr = np.arange(100000.0)
+    save_result(Path(tmpdir), _result(arr), format="buffers")
+    out = read_result(Path(tmpdir) / "_result.pklz").output.out
+    assert isinstance(out, helpers.MappedArray)
+    pickled = cp.dumps(out)
+    assert len(pickled) < 1000
+    out_2 = cp.loads(pickled)
+    assert isinstance(out_2, helpers.MappedArray)
+    assert np.array_equal(out_2, arr)
+    # views and new arrays are pickled with the data
+    assert np.array_equal(cp.loads(cp.dumps(out[::2])), arr[::2])
+    assert type(cp.loads(cp.dumps(out[::2]))) is np.ndarray
+    assert np.array_equal(cp.loads(cp.dumps(out + 1)), arr + 1)
+
+
+def test_make_klass():
+    """class is created once for specs with the same name, fields and bases"""
+    import typing as ty
+    from ..helpers import make_klass
+    from ..specs import SpecInfo, BaseSpec
+
+    def spec(default):
+        return SpecInfo(
+            name="Inputs", fields=[("a", ty.Any, default)], bases=(BaseSpec,)
+        )
+
+    assert make_klass(spec(1)) is make_klass(spec(1))
+    assert make_klass(spec(1)) is not make_klass(spec(True))
+    assert make_klass(spec(1)) is not make_klass(spec(2))
+    assert make_klass(spec(2))().a == 2
+
+
+def test_make_klass_threads(monkeypatch):
+    """classes are created and removed from the cache by many threads"""
+    import typing as ty
+    from concurrent.futures import ThreadPoolExecutor
+    from ..helpers import make_klass
+    from ..specs import SpecInfo, BaseSpec
+
+    monkeypatch.setattr(helpers, "_klasses", {})
+    monkeypatch.setattr(helpers, "_klasses_max", 4)
+
+    def create(nr):
+        for default in range(200):
+            spec = SpecInfo(
+                name="Inputs", fields=[("a", ty.Any, default)], bases=(BaseSpec,)
+            )
+            assert make_klass(spec)().a == default
+        return nr
+
+    with ThreadPoolExecutor(8) as pool:
+        assert list(pool.map(create, range(8))) == list(range(8))
+    assert len(helpers._klasses) <= 4
@@ -0,0 +1,142 @@
+import dataclasses as dc
+import os
+import typing as ty
+
+import numpy as np
+
+from .. import helpers_file
+from ..helpers_file import hash_spec, hash_value, hash_file, hash_dir
+from ..specs import BaseSpec, File, Directory
+
+
+@dc.dataclass
+class FileSpec(BaseSpec):
+    in_file: File
+    in_dir: ty.Optional[Directory] = None
+    a: int = 1
+
+
+def test_hash_file_content(tmpdir):
+    """files with the same content have the same hash"""
+    file_1 = tmpdir.join("file_1.txt")
+    file_1.write("content")
+    file_2 = tmpdir.join("file_2.txt")
+    file_2.write("content")
+    assert hash_spec(FileSpec(in_file=file_1)) == hash_spec(FileSpec(in_file=file_2))
+    file_2.write("new content")
+    assert hash_spec(FileSpec(in_file=file_1)) != hash_spec(FileSpec(in_file=file_2))
+    assert hash_spec(FileSpec(in_file=file_1)) != hash_spec(FileSpec(in_file=file_1, a=2))
+
+
+def test_hash_file_cache(tmpdir, monkeypatch):
+    """the file is read only once if the size and modification time are the same"""
+    file_1 = tmpdir.join("file_1.txt")
+    file_1.write("content")
+    hash_1 = hash_file(file_1)
+    monkeypatch.setattr(helpers_file, "_read_hash", lambda path: "reread")
+    assert hash_file(file_1) == hash_1
+    file_1.write("new content")
+    assert hash_file(file_1) == "reread"
+
+
+def test_hash_dir(tmpdir):
+    dir_1 = tmpdir.mkdir("dir_1")
+    dir_1.join("file.txt").write("content")
+    dir_2 = tmpdir.mkdir("dir_2")
+    dir_2.join("file.txt").write("content")
+    assert hash_dir(dir_1) == hash_dir(dir_2)
+    spec_1 = FileSpec(in_file="", in_dir=str(dir_1))
+    assert hash_spec(spec_1) == hash_spec(FileSpec(in_file="", in_dir=str(dir_2)))
+    dir_2.join("file_2.txt").write("content")
+    assert hash_dir(dir_1) != hash_dir(dir_2)
+
+
+def test_hash_array():
+    """arrays are hashed by the buffer, not by the truncated string"""
+    arr = np.zeros(10000)
+    arr_2 = arr.copy()
+    arr_2[5000] = 1
+    assert str(arr) == str(arr_2)
+    assert hash_value(arr) != hash_value(arr_2)
+    assert hash_value(arr) == hash_value(np.zeros(10000))
+    assert hash_value(arr) != hash_value(np.zeros(10000, dtype=int))
+    assert hash_value(np.arange(6).reshape(2, 3)) != hash_value(np.arange(6))
+    assert hash_value(np.arange(10)[::2]) == hash_value(np.arange(0, 10, 2))
+
+
+def test_hash_value():
+    assert hash_value([1, 2]) != hash_value((1, 2))
+    assert hash_value([1, 2]) != hash_value(["1", "2"])
+    assert hash_value({"a": 1, "b": 2}) == hash_value({"b": 2, "a": 1})
+    assert hash_value({1, 2, 3}) == hash_value({3, 2, 1})
+
+
+def test_hash_index(tmpdir, monkeypatch):
+    """hashes saved in the index are used by other processes (no in-memory cache)"""
+    file_1 = tmpdir.join("file_1.txt")
+    file_1.write("content")
+    index = helpers_file.hash_index(tmpdir)
+    hash_1 = hash_file(file_1, index)
+    assert tmpdir.join("_file_hashes.sqlite").exists()
+    monkeypatch.setattr(helpers_file, "_file_hashes", {})
+    monkeypatch.setattr(helpers_file, "_read_hash", lambda path: "reread")
+    assert hash_file(file_1, index) == hash_1
+    # the index is used only if it's given
+    monkeypatch.setattr(helpers_file, "_file_hashes", {})
+    assert hash_file(file_1) == "reread"
+    file_1.write("new content")
+    assert hash_file(file_1, index) == "reread"
+
+
+def test_hash_index_removed(tmpdir, monkeypatch):
+    """the index is created again if the cache directory is removed,
+    the file is hashed if the index can't be used
+    """
+    import shutil
+
+    file_1 = tmpdir.join("file_1.txt")
+    file_1.write("content")
+    cache_dir = tmpdir.mkdir("cache")
+    index = helpers_file.hash_index(cache_dir)
+    hash_1 = hash_file(file_1, index)
+    shutil.rmtree(cache_dir)
+    cache_dir.mkdir()
+    monkeypatch.setattr(helpers_file, "_file_hashes", {})
+    assert hash_file(file_1, index) == hash_1
+    assert index.get(_index_key(file_1)) == hash_1
+    # the cache directory doesn't exist
+    shutil.rmtree(cache_dir)
+    monkeypatch.setattr(helpers_file, "_file_hashes", {})
+    assert hash_file(file_1, index) == hash_1
+    # the index is not a database
+    cache_dir.mkdir().join("_file_hashes.sqlite").write("x" * 1000)
+    monkeypatch.setattr(helpers_file, "_file_hashes", {})
+    assert hash_file(file_1, index) == hash_1
+
+
+def _index_key(path):
+    stat = os.stat(path)
+    return (str(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _hash_in_process(args):
+    location, path = args
+    return hash_file(path, helpers_file.hash_index(location))
+
+
+def test_hash_index_processes(tmpdir):
+    """many processes write to the index at the same time"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    paths = []
+    for i in range(20):
+        file_i = tmpdir.join("file_{}.txt".format(i))
+        file_i.write(str(i))
+        paths.append(str(file_i))
+    with ProcessPoolExecutor(4) as pool:
+        hashes = list(pool.map(_hash_in_process, [(str(tmpdir), p) for p in paths]))
+    index = helpers_file.HashIndex(tmpdir.join("_file_hashes.sqlite"))
+    for path, file_hash in zip(paths, hashes):
+        stat = os.stat(path)
+        key = (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        assert index.get(key) == file_hash
@@ -0,0 +1,320 @@
+import concurrent.futures as cf
+import os
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from ..history import HISTORY_FILE, resource_history, size_class
+from ..scheduler import ResourceScheduler, critical_path
+from ..specs import Runtime
+from ..submitter import Submitter
+from ..task import to_task
+from ...utils.messenger import AuditFlag
+
+
+@to_task
+def fun_addtwo(a):
+    return a + 2
+
+
+@to_task
+def fun_sleep_pid(a):
+    """returns the pid, the start and end time"""
+    import os, time
+
+    start = time.time()
+    time.sleep(0.5)
+    return [os.getpid(), start, time.time()]
+
+
+class ManualWorker:
+    """worker that finishes jobs only when the test says so"""
+
+    def __init__(self):
+        self.running = []
+
+    def run_el(self, job):
+        future = cf.Future()
+        future.set_running_or_notify_cancel()
+        self.running.append((job, future))
+        return future
+
+    def finish(self, nr=0):
+        job, future = self.running.pop(nr)
+        future.set_result(job.template.node.name)
+
+
+class GraphWorkflow:
+    def __init__(self, graph):
+        self.graph = graph
+        self.graph_sorted = list(nx.topological_sort(graph))
+
+
+def _job(name, **resources):
+    nn = fun_addtwo(name=name, a=1).requirements(**resources)
+    return nn.to_job(None)
+
+
+def test_requirements():
+    nn = fun_addtwo(name="NA", a=1).requirements(cpu=2, mem_gb=1.5)
+    assert nn._runtime_requirements.cpu == 2
+    assert nn._runtime_requirements.mem_gb == 1.5
+    assert nn._runtime_requirements.gpu == 0
+    # the class default is not changed
+    assert fun_addtwo(name="NB", a=1)._runtime_requirements.cpu is None
+
+
+def test_scheduler_cpu_mem():
+    """jobs are packed till cpu or memory is used, waiting jobs run when jobs finish"""
+    worker = ManualWorker()
+    scheduler = ResourceScheduler(worker, cpu=4, mem_gb=8)
+    futures = [
+        scheduler.submit(_job("NA", cpu=2, mem_gb=2)),
+        scheduler.submit(_job("NB", cpu=2, mem_gb=6)),
+        scheduler.submit(_job("NC", cpu=1, mem_gb=1)),
+        scheduler.submit(_job("ND", cpu=1)),
+    ]
+    assert [job.template.node.name for job, _ in worker.running] == ["NA", "NB"]
+    assert scheduler.in_use == {"cpu": 4, "mem_gb": 8, "gpu": 0}
+    worker.finish(1)
+    assert futures[1].result() == "NB"
+    # both waiting jobs fit
+    assert [job.template.node.name for job, _ in worker.running] == ["NA", "NC", "ND"]
+    while worker.running:
+        worker.finish()
+    assert [future.result() for future in futures] == ["NA", "NB", "NC", "ND"]
+    assert scheduler.in_use == {"cpu": 0, "mem_gb": 0, "gpu": 0}
+
+
+def test_scheduler_packing_too_large():
+    """smaller jobs are not blocked by a large job,
+    a job larger than the capacity runs alone
+    """
+    worker = ManualWorker()
+    scheduler = ResourceScheduler(worker, cpu=2, mem_gb=4)
+    scheduler.submit(_job("NA", cpu=1))
+    scheduler.submit(_job("NB", mem_gb=16))
+    scheduler.submit(_job("NC", cpu=1))
+    assert [job.template.node.name for job, _ in worker.running] == ["NA", "NC"]
+    worker.finish()
+    worker.finish()
+    assert [job.template.node.name for job, _ in worker.running] == ["NB"]
+
+
+def test_scheduler_gpu():
+    """gpus are limited only if the number is given"""
+    worker = ManualWorker()
+    scheduler = ResourceScheduler(worker, cpu=4, mem_gb=4)
+    scheduler.submit(_job("NA", gpu=1))
+    scheduler.submit(_job("NB", gpu=1))
+    assert len(worker.running) == 2
+    assert scheduler.in_use["gpu"] == 2
+
+    worker = ManualWorker()
+    scheduler = ResourceScheduler(worker, cpu=4, mem_gb=4, gpu=1)
+    scheduler.submit(_job("NA", gpu=1))
+    scheduler.submit(_job("NB", gpu=1))
+    assert len(worker.running) == 1
+
+
+def test_scheduler_many_jobs():
+    """jobs with different requirements are taken from the heaps by priority"""
+    worker = ManualWorker()
+    scheduler = ResourceScheduler(worker, cpu=2, mem_gb=4)
+    for nr in range(200):
+        job = _job("N{}".format(nr), cpu=1 + nr % 2, mem_gb=nr % 3)
+        scheduler.submit(job, priority=nr % 5)
+    assert len(scheduler._waiting) == 6
+    names = []
+    while worker.running:
+        assert scheduler.in_use["cpu"] <= 2
+        names.append(worker.running[0][0].template.node.name)
+        worker.finish()
+    assert len(names) == 200
+    assert scheduler.nr_waiting == 0 and scheduler._waiting == {}
+
+
+def test_submitter_resources():
+    """one element at a time if every element requires all the cores"""
+    nn = fun_sleep_pid(name="NA").split(splitter="a", a=[1, 2, 3]).requirements(cpu=2)
+    with Submitter(plugin="cf", nr_proc=2, resources={"cpu": 2}) as sub:
+        sub.run(nn)
+        results = nn.result()
+    assert [inp["NA.a"] for inp, _ in results["out"]] == [1, 2, 3]
+    assert os.getpid() not in [out[0] for _, out in results["out"]]
+    times = sorted(out[1:] for _, out in results["out"])
+    assert all(prev[1] <= next_[0] for prev, next_ in zip(times, times[1:]))
+
+
+def test_history_record(tmpdir):
+    """runtime is recorded when resources are audited"""
+    nn = fun_addtwo(name="NA", a=3, audit_flags=AuditFlag.RESOURCE, cache_dir=tmpdir)
+    assert resource_history(tmpdir).estimate(nn) is None
+    nn.run()
+    estimate = resource_history(tmpdir).estimate(nn)
+    assert estimate["cpu"] >= 1
+    assert estimate["mem_gb"] > 0
+    # the same function with different (small) inputs
+    assert resource_history(tmpdir).estimate(fun_addtwo(name="NB", a=5)) == estimate
+
+
+def test_history_record_error(tmpdir):
+    """the result is saved if the history can't be recorded"""
+    os.mkdir(os.path.join(tmpdir, HISTORY_FILE))
+    nn = fun_addtwo(name="NA", a=3, audit_flags=AuditFlag.RESOURCE, cache_dir=tmpdir)
+    assert nn.run().output.out == 5
+    assert nn._cached_result().output.out == 5
+
+
+def test_history_removed(tmpdir):
+    """the history is created again if the cache directory is removed"""
+    import shutil
+
+    cache_dir = tmpdir.mkdir("cache")
+    nn = fun_addtwo(name="NA", a=1)
+    history = resource_history(cache_dir)
+    history.record(nn, Runtime(rss_peak_gb=1.0, cpu_peak_percent=90))
+    shutil.rmtree(cache_dir)
+    cache_dir.mkdir()
+    history.record(nn, Runtime(rss_peak_gb=2.0, cpu_peak_percent=90))
+    assert history.estimate(nn)["mem_gb"] == pytest.approx(2.4)
+    # the history is not a database
+    cache_dir.join(HISTORY_FILE).write("x" * 1000)
+    assert history.estimate(nn) is None
+
+
+def test_history_size_class(tmpdir):
+    """memory of runs with smaller inputs is scaled with the size"""
+    history = resource_history(tmpdir)
+    nn = fun_addtwo(name="NA", a=np.zeros(1024, dtype=np.uint8))
+    assert size_class(nn.inputs) == 11
+    for rss in [1.0, 2.0, 1.5]:
+        history.record(nn, Runtime(rss_peak_gb=rss, cpu_peak_percent=150.0))
+    assert history.estimate(nn) == {"cpu": 2, "mem_gb": pytest.approx(2.4)}
+    nn_large = fun_addtwo(name="NA", a=np.zeros(4096, dtype=np.uint8))
+    assert history.estimate(nn_large)["mem_gb"] == pytest.approx(2.4 * 4)
+    nn_small = fun_addtwo(name="NA", a=np.zeros(16, dtype=np.uint8))
+    assert history.estimate(nn_small)["mem_gb"] == pytest.approx(2.4)
+
+
+def test_scheduler_history(tmpdir):
+    """requirements that are not set by the task are estimated from the history"""
+    nn = fun_addtwo(name="NA", a=1, cache_dir=tmpdir)
+    resource_history(tmpdir).record(nn, Runtime(rss_peak_gb=3.0, cpu_peak_percent=90))
+    worker = ManualWorker()
+    scheduler = ResourceScheduler(worker, cpu=4, mem_gb=8)
+    for _ in range(3):
+        scheduler.submit(nn.to_job(None))
+    assert len(worker.running) == 2
+    assert scheduler.in_use["cpu"] == 2
+    assert scheduler.in_use["mem_gb"] == pytest.approx(7.2)
+    # the history is read once for the node
+    assert list(scheduler._estimates.values()) == [
+        {"cpu": 1, "mem_gb": pytest.approx(3.6)}
+    ]
+
+    worker = ManualWorker()
+    scheduler = ResourceScheduler(worker, cpu=4, mem_gb=8, adaptive=False)
+    for _ in range(3):
+        scheduler.submit(nn.to_job(None))
+    assert len(worker.running) == 3
+
+
+def test_critical_path():
+    """nodes on the longest path (duration) have the highest priority"""
+    graph = nx.DiGraph([("A", "B"), ("B", "C"), ("D", "C"), ("E", "F")])
+    priorities = critical_path(graph, {"A": 5.0, "E": 2.0})
+    assert priorities == {"A": 7, "B": 2, "C": 1, "D": 2, "E": 3, "F": 1}
+
+
+def test_scheduler_priority():
+    """waiting jobs with higher priority are submitted first"""
+    worker = ManualWorker()
+    scheduler = ResourceScheduler(worker, cpu=1, mem_gb=1)
+    scheduler.submit(_job("NA"), priority=1)
+    scheduler.submit(_job("NB"), priority=1)
+    scheduler.submit(_job("NC"), priority=5)
+    scheduler.submit(_job("ND"), priority=1)
+    names = []
+    while worker.running:
+        names.append(worker.running[0][0].template.node.name)
+        worker.finish()
+    assert names == ["NA", "NC", "NB", "ND"]
+
+
+def test_scheduler_history_size(tmpdir):
+    """estimates are cached for the size of the inputs,
+    chunks are estimated from the element with the largest inputs
+    """
+    arrays = [np.zeros(1024, dtype=np.uint8), np.zeros(4096, dtype=np.uint8)]
+    history = resource_history(tmpdir)
+    history.record(
+        fun_addtwo(name="NA", a=arrays[0], cache_dir=tmpdir),
+        Runtime(rss_peak_gb=1.0, cpu_peak_percent=90),
+    )
+    nn = fun_addtwo(name="NA", cache_dir=tmpdir).split(splitter="a", a=arrays)
+    nn.state.prepare_states(nn.inputs)
+    worker = ManualWorker()
+    scheduler = ResourceScheduler(worker, cpu=8, mem_gb=100)
+    scheduler.submit(nn.to_job(0))
+    scheduler.submit(nn.to_job(1))
+    assert scheduler.in_use["mem_gb"] == pytest.approx(1.2 + 4.8)
+    scheduler.submit(nn.to_job_chunk([0, 1]))
+    assert scheduler.in_use["mem_gb"] == pytest.approx(1.2 + 4.8 + 4.8)
+    assert len(scheduler._estimates) == 2
+
+
+def test_submitter_priorities(tmpdir):
+    """priorities of the nodes use durations from the history"""
+    na = fun_addtwo(name="NA", cache_dir=tmpdir)
+    nb = fun_sleep_pid(name="NB", cache_dir=tmpdir)
+    nc = fun_addtwo(name="NC", cache_dir=tmpdir)
+    runtime = Runtime(rss_peak_gb=0.1, duration_sec=10.0)
+    resource_history(tmpdir).record(nb, runtime)
+    graph = nx.DiGraph([(na, nc), (nb, nc)])
+    workflow = GraphWorkflow(graph)
+    with Submitter(plugin="serial") as sub:
+        sub._set_priorities(workflow)
+        assert sub._priority == {na: 2.0, nb: 11.0, nc: 1.0}
+
+
+def test_submitter_durations_cached(tmpdir, monkeypatch):
+    """durations are read from the history once for every task type"""
+    na = fun_addtwo(name="NA", cache_dir=tmpdir)
+    nb = fun_sleep_pid(name="NB", cache_dir=tmpdir)
+    nc = fun_addtwo(name="NC", cache_dir=tmpdir)
+    resource_history(tmpdir).record(nb, Runtime(rss_peak_gb=0.1, duration_sec=10.0))
+    history = resource_history(tmpdir)
+    nodes = []
+    duration = type(history).duration
+
+    def counted_duration(self, node):
+        nodes.append(node.name)
+        return duration(self, node)
+
+    monkeypatch.setattr(type(history), "duration", counted_duration)
+    workflow = GraphWorkflow(nx.DiGraph([(na, nc), (nb, nc)]))
+    with Submitter(plugin="serial") as sub:
+        sub._set_priorities(workflow)
+        sub._set_priorities(workflow)
+        assert sub._priority == {na: 2.0, nb: 11.0, nc: 1.0}
+    assert sorted(nodes) == ["NA", "NB"]
+
+
+def test_submitter_ready_priority(tmpdir, monkeypatch):
+    """nodes that have all inputs are submitted in the order of the priorities"""
+    na = fun_addtwo(name="NA", cache_dir=tmpdir)
+    nb = fun_sleep_pid(name="NB", cache_dir=tmpdir)
+    nc = fun_addtwo(name="NC", cache_dir=tmpdir)
+    resource_history(tmpdir).record(nb, Runtime(rss_peak_gb=0.1, duration_sec=10.0))
+    workflow = GraphWorkflow(nx.DiGraph([(na, nc), (nb, nc)]))
+    assert workflow.graph_sorted.index(na) < workflow.graph_sorted.index(nb)
+    monkeypatch.setattr(
+        type(na), "prepare_state_input", lambda self: None, raising=False
+    )
+    names = []
+    with Submitter(plugin="serial") as sub:
+        monkeypatch.setattr(sub, "_submit_node", lambda node: names.append(node.name))
+        sub._run_workflow_nd(workflow)
+    assert names == ["NB", "NA", "NC"]
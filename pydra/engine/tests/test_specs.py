@@ -31,6 +31,24 @@ def test_result():
     assert hasattr(result, "output")
 
 
+def test_result_output_klass(monkeypatch):
+    """output classes of the unpickled results are shared, the number is limited"""
+    import dataclasses as dc
+    import pickle as pk
+    from .. import specs
+
+    monkeypatch.setattr(specs, "_output_klasses", {})
+    monkeypatch.setattr(specs, "_output_klasses_max", 2)
+    Output = dc.make_dataclass("Output", [("out", int)])
+    result = Result(output=Output(out=1))
+    outputs = [pk.loads(pk.dumps(result)).output for _ in range(2)]
+    assert type(outputs[0]) is type(outputs[1])
+    assert outputs[0].out == 1
+    for name in ["Output_1", "Output_2", "Output_3"]:
+        pk.loads(pk.dumps(Result(output=dc.make_dataclass(name, [("a", int)])(a=1))))
+    assert len(specs._output_klasses) == 2
+
+
 def test_shellspec():
     with pytest.raises(TypeError):
         spec = ShellSpec()
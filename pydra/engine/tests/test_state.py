@@ -37,6 +37,54 @@ def test_state_1(inputs, splitter, ndim, states_ind, states_val, group_for_input
     assert st.states_val == states_val
 
 
+def test_state_ind_array():
+    """state indices are kept in one array, dictionaries are created when needed"""
+    st = State(name="NA", splitter=["a", ("b", "c")])
+    st.prepare_states(inputs={"NA.a": [1, 2], "NA.b": [3, 4, 5], "NA.c": [6, 7, 8]})
+    assert st.states_ind_array.shape == (6, 3)
+    assert len(st.states_ind) == 6
+    assert st.states_ind[4] == {"NA.a": 1, "NA.b": 1, "NA.c": 1}
+    assert st.states_ind[:2] == [{"NA.a": 0, "NA.b": 0, "NA.c": 0},
+                                 {"NA.a": 0, "NA.b": 1, "NA.c": 1}]
+    assert st.ind_l[-1] == (1, 2, 2)
+    assert st.ind_l_final == st.ind_l
+    # the views are sequences
+    assert list(st.states_ind) == st.states_ind[:]
+    assert st.states_ind.index({"NA.a": 1, "NA.b": 1, "NA.c": 1}) == 4
+    assert {"NA.a": 0, "NA.b": 2, "NA.c": 2} in st.states_ind
+
+
+def test_state_val_lazy():
+    """state values are created on demand, for one element or a slice"""
+    st = State(name="NA", splitter=["a", "b", "c"])
+    st.prepare_states(inputs={"NA.a": list(range(100)), "NA.b": list(range(100)),
+                              "NA.c": list(range(100))})
+    assert len(st.states_val) == 10 ** 6
+    assert st.states_val[123456] == {"NA.a": 12, "NA.b": 34, "NA.c": 56}
+    assert st.states_val[-1] == {"NA.a": 99, "NA.b": 99, "NA.c": 99}
+    assert st.states_val[1:3] == [{"NA.a": 0, "NA.b": 0, "NA.c": 1},
+                                  {"NA.a": 0, "NA.b": 0, "NA.c": 2}]
+    assert next(iter(st.states_val)) == {"NA.a": 0, "NA.b": 0, "NA.c": 0}
+    with pytest.raises(IndexError):
+        st.states_val[10 ** 6]
+
+
+def test_state_compiled():
+    """splitter is parsed once and shared by states and their copies"""
+    from copy import deepcopy
+    st1 = State(name="NA", splitter=["a", "b"], combiner="a")
+    st2 = State(name="NA", splitter=["a", "b"], combiner="a")
+    assert st1.compiled is st2.compiled
+    assert st1.splitter_rpn is st2.splitter_rpn
+    st3 = deepcopy(st1)
+    assert st3.compiled is st1.compiled
+    assert st3.groups_stack_final is st1.groups_stack_final
+    assert st3.splitter_rpn_final == ["NA.b"]
+    st4 = State(name="NA", splitter=("a", "b"))
+    assert st4.compiled is not st1.compiled
+    assert st4.splitter_rpn == ["NA.a", "NA.b", "."]
+
+
 def test_state_merge_1():
     st1 = State(name="NA", splitter="a")
     st2 = State(name="NB", other_states={"NA": (st1, "b")})
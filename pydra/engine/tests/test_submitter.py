@@ -0,0 +1,337 @@
+import asyncio
+import concurrent.futures as cf
+import os
+import sys
+import time
+
+from filelock import FileLock
+import pytest
+
+from ..history import resource_history
+from ..specs import Runtime
+from ..state import State
+from ..submitter import Submitter
+from ..task import to_task, ShellCommandTask
+
+Plugins = ["cf"]
+
+
+@to_task
+def fun_addvar(a, b):
+    return a + b
+
+
+@to_task
+async def fun_addvar_async(a, b):
+    await asyncio.sleep(0.5)
+    return a + b
+
+
+@to_task
+async def fun_times_async(a):
+    """sleeping a seconds, returns the start and end time"""
+    start = time.time()
+    await asyncio.sleep(a)
+    return [start, time.time()]
+
+
+def _overlap(times):
+    """all tasks were running at the same time"""
+    return max(start for start, _ in times) < min(end for _, end in times)
+
+
+@pytest.mark.parametrize("plugin", Plugins)
+def test_submitter_completion_1(plugin):
+    """all elements are reported back by the worker, no polling between checks"""
+    nn = fun_addvar(name="NA").split(splitter=("a", "b"), a=[3, 5], b=[10, 20])
+    with Submitter(plugin=plugin) as sub:
+        sub._submit_node(nn)
+        sub._wait_for_completion()
+        assert sub._in_flight == 0
+        assert sub._completed.empty()
+    assert nn.done
+    assert [nn.results_dict[i].result().output.out for i in range(2)] == [13, 25]
+
+
+@pytest.mark.parametrize("plugin", Plugins)
+def test_submitter_completion_2(plugin):
+    """element that waits for inputs, but nothing is running"""
+    na, nb = _connected_nodes()
+    with Submitter(plugin=plugin) as sub:
+        sub._add_to_line(nb, 0)
+        with pytest.raises(Exception) as excinfo:
+            sub._wait_for_completion()
+    assert "inputs are missing for: ['NB']" in str(excinfo.value)
+
+
+def test_submitter_async_1():
+    """elements of a coroutine function are awaited concurrently"""
+    nn = fun_addvar_async(name="NA").split(splitter=["a", "b"], a=[3, 5], b=[10, 20])
+    with Submitter(plugin="async") as sub:
+        sub.run(nn)
+    results = nn.result()
+    assert [res[1] for res in results["out"]] == [13, 23, 15, 25]
+    nn = fun_times_async(name="NB").split(splitter="a", a=[0.5] * 4)
+    with Submitter(plugin="async") as sub:
+        sub.run(nn)
+    assert _overlap([res[1] for res in nn.result()["out"]])
+
+
+def test_submitter_async_2():
+    """shell commands from many tasks run as children of one event loop"""
+    # the command prints the start and end time
+    code = "import time; print(time.time()); time.sleep(0.5); print(time.time())"
+    tasks = [
+        ShellCommandTask(
+            name="sleep{}".format(i), executable=[sys.executable, "-c", code]
+        )
+        for i in range(4)
+    ]
+
+    async def run_all(sub):
+        await asyncio.gather(*[sub.run_async(task) for task in tasks])
+
+    with Submitter(plugin="async") as sub:
+        asyncio.run(run_all(sub))
+    times = []
+    for task in tasks:
+        output = task.results_dict[None].result().output
+        assert output.return_code == 0
+        times.append([float(line) for line in output.stdout.split()])
+    assert _overlap(times)
+
+
+def test_submitter_async_running_loop():
+    """the async plugin can be used from a coroutine (inside a running loop)"""
+    nn = fun_addvar_async(name="NA").split(splitter="a", a=[3, 5], b=10)
+
+    async def run_node():
+        with Submitter(plugin="async") as sub:
+            sub.run(nn)
+        return nn.result()
+
+    results = asyncio.run(run_node())
+    assert [res[1] for res in results["out"]] == [13, 15]
+
+
+def test_run_async_lock(tmpdir):
+    """waiting for the lock of an equivalent task doesn't block the event loop"""
+    nn = fun_addvar_async(name="NA", a=1, b=2, cache_dir=tmpdir)
+    lock = FileLock(str(tmpdir.join(nn.checksum + ".lock")))
+    done = []
+
+    async def run_locked():
+        lock.acquire()
+        task = asyncio.ensure_future(nn.run_async())
+        for _ in range(3):
+            await asyncio.sleep(0.1)
+            done.append(task.done())
+        lock.release()
+        return await task
+
+    assert asyncio.run(run_locked()).output.out == 3
+    assert done == [False, False, False]
+
+
+@pytest.mark.parametrize("plugin", ["serial", "cf"])
+@pytest.mark.parametrize("chunksize", [2, 3, "auto"])
+def test_submitter_chunks_1(plugin, chunksize):
+    """contiguous elements are sent to the worker as one job"""
+    nn = fun_addvar(name="NA").split(splitter=["a", "b"], a=[3, 5], b=[10, 20, 30])
+    with Submitter(plugin=plugin, chunksize=chunksize) as sub:
+        sub.run(nn)
+        results = nn.result()
+    assert [res[1] for res in results["out"]] == [13, 23, 33, 15, 25, 35]
+
+
+@pytest.mark.parametrize(
+    "chunksize, nr_proc, nr_el, expected",
+    [(None, 2, 100, 1), (5, 2, 100, 5), ("auto", 2, 100, 13), ("auto", 4, 3, 1)],
+)
+def test_submitter_chunksize(chunksize, nr_proc, nr_el, expected):
+    with Submitter(plugin="cf", chunksize=chunksize, nr_proc=nr_proc) as sub:
+        assert sub._chunksize(nr_el) == expected
+
+
+def test_submitter_dry_run(tmpdir):
+    """checking the cache without running, only elements that are missing are run"""
+    nn = fun_addvar(name="NA", cache_dir=tmpdir).split(
+        splitter=("a", "b"), a=[3, 5], b=[10, 20]
+    )
+    with Submitter(plugin="serial") as sub:
+        report = sub.dry_run(nn)["NA"]
+        assert report.hits == [] and report.misses == [0, 1]
+        # the task hasn't been run before
+        assert report.duration_sec is None
+        sub.run(nn)
+        # the results are not touched by dry_run
+        output_dirs = [path for path in tmpdir.listdir() if path.isdir()]
+        for path in output_dirs:
+            os.utime(str(path), (1000, 1000))
+        report = sub.dry_run(nn)["NA"]
+        assert report.hits == [0, 1] and report.misses == []
+        assert [path.mtime() for path in output_dirs] == [1000] * len(output_dirs)
+
+    # runs are saved in the history when the resources are monitored
+    runtime = Runtime(rss_peak_gb=0.1, duration_sec=2.0)
+    resource_history(tmpdir).record(fun_addvar(name="NA", a=1, b=1), runtime)
+    nn2 = fun_addvar(name="NA", cache_dir=tmpdir).split(
+        splitter=("a", "b"), a=[3, 7], b=[10, 20]
+    )
+    with Submitter(plugin="serial") as sub:
+        report = sub.dry_run(nn2)["NA"]
+    assert (report.hits, report.misses, report.nr_elements) == ([0], [1], 2)
+    assert report.duration_sec == pytest.approx(2.0)
+
+
+def test_submitter_cache_only(tmpdir):
+    """cache_only reads results from the cache and fails if any is missing"""
+    nn = fun_addvar(name="NA", cache_dir=tmpdir).split(
+        splitter=("a", "b"), a=[3, 5], b=[10, 20]
+    )
+    with Submitter(plugin="serial") as sub:
+        sub.run(nn)
+
+    nn = fun_addvar(name="NA", cache_locations=[tmpdir]).split(
+        splitter=("a", "b"), a=[3, 5], b=[10, 20]
+    )
+    with Submitter(plugin="cf", cache_only=True) as sub:
+        sub.run(nn)
+        results = nn.result()
+    assert [res[1] for res in results["out"]] == [13, 25]
+
+    nn = fun_addvar(name="NA", cache_locations=[tmpdir]).split(
+        splitter=("a", "b"), a=[3, 7], b=[10, 20]
+    )
+    with Submitter(plugin="cf", cache_only=True) as sub:
+        with pytest.raises(Exception) as excinfo:
+            sub.run(nn)
+    assert "state indices: [1]" in str(excinfo.value)
+
+
+@to_task
+def fun_ones(n):
+    import numpy as np
+
+    return np.ones(n)
+
+
+def test_submitter_mapped_arrays():
+    """large arrays from workers are memory-mapped, not copied"""
+    import cloudpickle as cp
+    from ..helpers import MappedArray
+
+    nn = fun_ones(name="NA", n=100000)
+    with Submitter(plugin="cf") as sub:
+        sub.run(nn)
+        out = nn.results_dict[None].result().output.out
+    assert isinstance(out, MappedArray)
+    assert out.sum() == 100000
+    # the array is passed to other jobs as a handle
+    job = fun_addvar(name="NB", a=out, b=1).to_job(None)
+    assert len(cp.dumps(out)) < 1000
+    assert job().output.out.sum() == 200000
+
+
+def test_job_checksum_shared_array(monkeypatch):
+    """an array input that is not split is hashed once for all elements,
+    the checksums are the same as checksums of the nodes
+    """
+    import numpy as np
+    from .. import helpers_file
+
+    arrays = []
+    hash_value = helpers_file.hash_value
+
+    def counted_hash_value(value, *args, **kwargs):
+        if isinstance(value, np.ndarray):
+            arrays.append(value)
+        return hash_value(value, *args, **kwargs)
+
+    nn = fun_addvar(name="NA", b=np.ones(1000)).split(splitter="a", a=[1, 2, 3])
+    nn.state.prepare_states(nn.inputs)
+    template = nn.job_template()
+    monkeypatch.setattr(helpers_file, "hash_value", counted_hash_value)
+    checksums = [nn.to_job(ind, template).checksum for ind in range(3)]
+    assert len(arrays) == 1
+    assert len(set(checksums)) == 3
+    for ind, checksum in enumerate(checksums):
+        assert nn.to_job(ind).node.checksum == checksum
+
+
+def _connected_nodes():
+    """NB uses the output of NA, elements are matched by the splitter of NA"""
+    na = fun_addvar(name="NA", b=0).split(splitter="a", a=[1, 2, 3])
+    na.state.prepare_states(na.inputs)
+    nb = fun_addvar(name="NB", b=10)
+    nb.needed_outputs = [(na, "out", "a")]
+    nb.state = State(name="NB", splitter="_NA", other_states={"NA": (na.state, "a")})
+    nb.state.prepare_states({"NA.a": [1, 2, 3]})
+    return na, nb
+
+
+def test_upstream_elements():
+    """an element is ready when the upstream element it uses is finished"""
+    na, nb = _connected_nodes()
+    assert nb.upstream_elements(1) == [(na, 1)]
+    assert not nb.ready2run(1)
+    future = cf.Future()
+    future.set_result(None)
+    na.results_dict[1] = future
+    assert nb.ready2run(1)
+    assert not nb.ready2run(0)
+    assert not na.is_finished()
+
+
+def test_submitter_element_dataflow():
+    """elements of NB are submitted when the elements of NA are finished"""
+    na, nb = _connected_nodes()
+    with Submitter(plugin="serial") as sub:
+        for ind in range(3):
+            sub._add_to_line(nb, ind)
+        sub._submit_node(na)
+        sub._wait_for_completion()
+    assert [nb.results_dict[i].result().output.out for i in range(3)] == [11, 12, 13]
+
+
+def test_submitter_pending_counters():
+    """waiting elements are counted as dependents of the upstream elements"""
+    na, nb = _connected_nodes()
+    with Submitter(plugin="serial") as sub:
+        for ind in range(3):
+            sub._add_to_line(nb, ind)
+        assert sub._pending == {(nb, 0): 1, (nb, 1): 1, (nb, 2): 1}
+        assert sub._dependents[(na, 1)] == [(nb, 1)]
+        sub._submit_node(na)
+        sub._element_finished(na, 1)
+        assert sub.node_line == {nb: {0, 2}}
+        assert nb.results_dict[1].result().output.out == 12
+        # elements added after the upstream elements are finished are run
+        del nb.results_dict[1]
+        sub._add_to_line(nb, 1)
+        assert (nb, 1) not in sub._pending
+        assert sub.node_line == {nb: {0, 2}}
+        assert nb.results_dict[1].result().output.out == 12
+
+
+def test_submitter_dask_graph(monkeypatch):
+    """elements of NB are submitted with the dask futures of the elements of NA,
+    the template of NB is created once
+    """
+    na, nb = _connected_nodes()
+    templates = []
+    job_template = type(nb).job_template
+
+    def counted_job_template(node):
+        templates.append(node.name)
+        return job_template(node)
+
+    monkeypatch.setattr(type(nb), "job_template", counted_job_template)
+    with Submitter(
+        plugin="dask", n_workers=2, processes=False, dashboard_address=None
+    ) as sub:
+        sub._submit_node(na)
+        assert all(sub._submit_graph_el(nb, ind) for ind in range(3))
+        sub._wait_for_completion()
+    assert templates == ["NA", "NB"]
+    assert [nb.results_dict[i].result().output.out for i in range(3)] == [11, 12, 13]
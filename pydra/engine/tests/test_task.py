@@ -2,8 +2,10 @@
 
 import typing as ty
 import os
+import pickle
 import pytest
 
+from ..specs import File
 from ..task import to_task, AuditFlag, ShellCommandTask, ContainerTask, DockerTask
 from ...utils.messenger import PrintMessenger, FileMessenger, collect_messages
 
@@ -19,6 +21,30 @@ def test_output():
     assert res.output.out == 5
 
 
+def test_cache(tmpdir):
+    """result from a previous run is returned without running the task again"""
+
+    @to_task
+    def funaddtwo(a):
+        return a + 2
+
+    cache_dir = tmpdir.mkdir("cache")
+    nn = funaddtwo(a=3, cache_dir=cache_dir)
+    res = nn.run()
+    result_file = nn.output_dir / "_result.pklz"
+    mtime = result_file.stat().st_mtime_ns
+    res = nn.run()
+    assert res.output.out == 5
+    assert result_file.stat().st_mtime_ns == mtime
+
+    # read-only locations are also checked, nothing is written to the new cache_dir
+    nn2 = funaddtwo(
+        a=3, cache_dir=tmpdir.mkdir("cache2"), cache_locations=[cache_dir]
+    )
+    assert nn2.run().output.out == 5
+    assert not nn2.output_dir.exists()
+
+
 @pytest.mark.xfail(
     reason="when task run without submitter, results are not collected,"
     "so result() method will not work"
@@ -127,6 +153,103 @@ def test_notannotated_func():
     assert result.output.out == 20.2
 
 
+def test_to_job():
+    @to_task
+    def fun_addvar(a, b):
+        return a + b
+
+    nn = fun_addvar(name="NA").split(splitter=("a", "b"), a=[3, 5], b=[10, 20])
+    nn.state.prepare_states(nn.inputs)
+    template = nn.job_template()
+    jobs = [nn.to_job(i, template=template) for i in range(2)]
+    assert jobs[1].inputs == {"a": 5, "b": 20}
+    assert template.node.state is None
+    assert nn.state is not None
+
+    # the template is pickled once and unpickled once per process
+    job0, job1 = [pickle.loads(pickle.dumps(job)) for job in jobs]
+    assert job0.template.node is job1.template.node
+    assert job0().output.out == 13
+    assert job1().output.out == 25
+
+
+def test_job_size(tmpdir):
+    """the template doesn't include inputs of the elements,
+    a saved template is sent only with the key and the path
+    """
+
+    @to_task
+    def fun_addvar(a, b):
+        return a + b
+
+    def job_sizes(nr):
+        nn = fun_addvar(name="NA", b=1).split(splitter="a", a=list(range(nr)))
+        nn.state.prepare_states(nn.inputs)
+        template = nn.job_template()
+        job = nn.to_job(nr - 1, template=template)
+        assert job.inputs == {"a": nr - 1}
+        assert template.node.inputs.a is None and template.node.state_inputs == {}
+        size = len(pickle.dumps(job))
+        template.save(tmpdir)
+        return size, len(pickle.dumps(job))
+
+    # the first pickle of the input spec class is different
+    job_sizes(10)
+    size_10, saved_10 = job_sizes(10)
+    size_10000, saved_10000 = job_sizes(10000)
+    assert size_10000 - size_10 < 10
+    assert saved_10000 < 500
+
+
+def test_job_checksum(tmpdir, monkeypatch):
+    """checksum of the job is computed once and sent to the worker,
+    files are hashed with the hash index of the cache directory
+    """
+    from .. import helpers_file
+
+    @to_task
+    def fun_file(in_file: File):
+        return os.path.getsize(in_file)
+
+    in_file = tmpdir.join("in.txt")
+    in_file.write("content")
+    nn = fun_file(name="NA", in_file=str(in_file), cache_dir=tmpdir.mkdir("cache"))
+    job = nn.to_job(None)
+    checksum = job.checksum
+    assert (nn.cache_dir / "_file_hashes.sqlite").exists()
+
+    def read_hash(*args):
+        raise Exception("the file is hashed again")
+
+    monkeypatch.setattr(helpers_file, "_read_hash", read_hash)
+    monkeypatch.setattr(helpers_file.HashIndex, "get", read_hash)
+    monkeypatch.setattr(helpers_file, "_file_hashes", {})
+    job = pickle.loads(pickle.dumps(job))
+    assert job.node.checksum == checksum
+    assert job().output.out == 7
+    assert (nn.cache_dir / checksum / "_result.pklz").exists()
+
+
+def test_pickle_node():
+    """specs are not pickled separately, inputs are not copied, results are not included"""
+    import concurrent.futures as cf
+
+    @to_task
+    def fun_sum(a, b):
+        return sum(a) + b
+
+    a = list(range(1000))
+    nn = fun_sum(name="NA", a=a, b=1)
+    nn.results_dict[None] = cf.Future()
+    nn2 = pickle.loads(pickle.dumps(nn))
+    assert nn2.results_dict == {}
+    assert type(nn2.inputs) is type(nn.inputs)
+    assert nn2.inputs.a == a
+    # a is pickled once (also used by state_inputs)
+    assert nn2.inputs.a is nn2.state_inputs["a"]
+    assert nn2.run().output.out == sum(a) + 1
+
+
 def test_exception_func():
     @to_task
     def raise_exception(c, d):
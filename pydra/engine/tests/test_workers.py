@@ -0,0 +1,222 @@
+import os
+
+import numpy as np
+import pytest
+
+from ..workers import (
+    MpWorker,
+    SerialWorker,
+    DaskWorker,
+    ThreadWorker,
+    WarmPoolWorker,
+    close_warm_pools,
+    warm_pool,
+)
+from ..submitter import Submitter
+from ..task import to_task
+
+
+@to_task
+def fun_sleep(a):
+    import time
+
+    time.sleep(a)
+    return a
+
+
+@to_task
+def fun_identity(a):
+    return a
+
+
+@to_task
+def fun_times(a):
+    """sleeping a seconds, returns the start and end time"""
+    import time
+
+    start = time.time()
+    time.sleep(a)
+    return [start, time.time()]
+
+
+def _overlap(times):
+    """all jobs were running at the same time"""
+    return max(start for start, _ in times) < min(end for _, end in times)
+
+
+def _one_at_a_time(times):
+    """no jobs were running at the same time"""
+    times = sorted(times)
+    return all(prev[1] <= next_[0] for prev, next_ in zip(times, times[1:]))
+
+
+@to_task
+def fun_pid_preloaded(a):
+    import os, sys
+
+    return [os.getpid(), "colorsys" in sys.modules]
+
+
+def test_mpworker_1():
+    """run_el doesn't wait for the results, but returns futures"""
+    worker = MpWorker(nr_proc=2)
+    futures = [worker.run_el(fun_times(a=0.5)) for _ in range(2)]
+    assert not any([fut.done() for fut in futures])
+    assert _overlap([fut.result().output.out for fut in futures])
+    worker.close()
+
+
+def test_mpworker_2():
+    """number of the submitted jobs is bounded by max_jobs"""
+    worker = MpWorker(nr_proc=1, max_jobs=1)
+    futures = [worker.run_el(fun_times(a=0.5))]
+    # no free slot till the first job is finished
+    assert not worker._slots.acquire(blocking=False)
+    # the second job waits for the slot
+    futures.append(worker.run_el(fun_times(a=0.5)))
+    assert _one_at_a_time([fut.result().output.out for fut in futures])
+    worker.close()
+
+
+def test_mpworker_template():
+    """the template is saved once by the worker and removed when it's closed"""
+    nn = fun_identity(name="NA").split(splitter="a", a=[1, 2, 3])
+    nn.state.prepare_states(nn.inputs)
+    template = nn.job_template()
+    worker = MpWorker(nr_proc=2)
+    futures = [worker.run_el(nn.to_job(ind, template=template)) for ind in range(3)]
+    assert [fut.result().output.out for fut in futures] == [1, 2, 3]
+    assert os.listdir(worker.templates_dir) == ["{}.pklz".format(template.key)]
+    worker.close()
+    assert not os.path.exists(worker.templates_dir)
+
+
+def test_serialworker_1():
+    worker = SerialWorker()
+    future = worker.run_el(fun_sleep(a=0))
+    assert future.done()
+    assert future.result().output.out == 0
+
+
+def _sleep_jobs(nr, thread_safe):
+    nn = fun_times(name="NA").split(splitter="a", a=[0.5] * nr)
+    nn.thread_safe = thread_safe
+    nn.state.prepare_states(nn.inputs)
+    template = nn.job_template()
+    return [nn.to_job(ind, template=template) for ind in range(nr)]
+
+
+def test_threadworker_1():
+    """thread safe jobs run at the same time, results are not read from the cache"""
+    worker = ThreadWorker(nr_proc=2)
+    futures = [worker.run_el(job) for job in _sleep_jobs(2, thread_safe=True)]
+    assert _overlap([fut.result().output.out for fut in futures])
+    worker.close()
+
+
+def test_threadworker_in_memory(tmpdir):
+    """outputs are passed without pickling"""
+    arr = np.arange(100000.0)
+    nn = fun_identity(name="NA", a=arr, cache_dir=tmpdir)
+    nn.thread_safe = True
+    worker = ThreadWorker(nr_proc=1)
+    assert worker.run_el(nn.to_job(None)).result().output.out is arr
+    worker.close()
+
+
+def test_threadworker_2():
+    """jobs that are not thread safe run one at a time"""
+    worker = ThreadWorker(nr_proc=2)
+    futures = [worker.run_el(job) for job in _sleep_jobs(2, thread_safe=False)]
+    assert _one_at_a_time([fut.result().output.out for fut in futures])
+    worker.close()
+
+
+def test_warm_pool_reused():
+    """the pool is kept by the next submitter, modules from preload are imported"""
+    kwargs = {"nr_proc": 2, "preload": ["colorsys"]}
+    pids = []
+    for _ in range(2):
+        nn = fun_pid_preloaded(name="NA").split(splitter="a", a=[1, 2, 3])
+        with Submitter(plugin="warm", **kwargs) as sub:
+            sub.run(nn)
+            pool = sub.worker.pool
+            results = [out for _, out in nn.result()["out"]]
+        assert all(preloaded for _, preloaded in results)
+        pids.append({pid for pid, _ in results})
+    assert WarmPoolWorker(**kwargs).pool is pool
+    assert pids[0] & pids[1]
+    close_warm_pools()
+
+
+def test_warm_pool_recycling():
+    """processes are replaced after max_tasks_per_child tasks"""
+    worker = WarmPoolWorker(nr_proc=1, max_tasks_per_child=1)
+    nn = fun_pid_preloaded(name="NA").split(splitter="a", a=[1, 2, 3])
+    nn.state.prepare_states(nn.inputs)
+    futures = [worker.run_el(nn.to_job(ind)) for ind in range(3)]
+    pids = [future.result().output.out[0] for future in futures]
+    assert len(set(pids)) == 3
+    close_warm_pools()
+
+
+def test_warm_pool_threads():
+    """workers created at the same time in several threads share one pool"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(4) as executor:
+        pools = list(executor.map(lambda _: warm_pool(1, ["colorsys"]), range(8)))
+    assert all(pool is pools[0] for pool in pools)
+    close_warm_pools()
+    assert warm_pool(1, ["colorsys"]) is not pools[0]
+    close_warm_pools()
+
+
+def test_daskworker_1():
+    """run_el doesn't wait for the results, but returns futures"""
+    worker = DaskWorker(n_workers=2, processes=False, dashboard_address=None)
+    futures = [worker.run_el(fun_times(a=0.5)) for _ in range(2)]
+    assert not any([fut.done() for fut in futures])
+    assert _overlap([fut.result().output.out for fut in futures])
+    worker.close()
+
+
+def test_daskworker_lazy():
+    """results stay on the cluster till they are used, errors are passed"""
+    import concurrent.futures as cf
+
+    worker = DaskWorker(n_workers=1, processes=False, dashboard_address=None)
+    futures = [worker.run_el(fun_identity(a=2)), worker.run_el(fun_identity(a=None))]
+    futures.append(worker.run_el(fun_sleep(a="x")))
+    cf.wait(futures)
+    assert not any(fut._gathered for fut in futures)
+    assert futures[0].result().output.out == 2
+    assert futures[0]._gathered
+    assert futures[2].exception() is not None
+    with pytest.raises(TypeError):
+        futures[2].result()
+    worker.close()
+
+
+@pytest.mark.parametrize("plugin", ["serial", "mp", "cf", "threads", "dask"])
+def test_submitter_plugins(plugin):
+    nn = fun_sleep(name="NA").split(splitter="a", a=[0, 0.1])
+    kwargs = {}
+    if plugin == "dask":
+        kwargs = {"n_workers": 1, "processes": False, "dashboard_address": None}
+    with Submitter(plugin=plugin, **kwargs) as sub:
+        sub.run(nn)
+    # the submitter waits for the jobs, results are read after it's closed
+    results = nn.result()
+    assert results["out"] == [({"NA.a": 0}, 0), ({"NA.a": 0.1}, 0.1)]
+
+
+def test_daskworker_close_running():
+    """jobs that are still running are finished and gathered by close, errors are kept"""
+    worker = DaskWorker(n_workers=1, processes=False, dashboard_address=None)
+    futures = [worker.run_el(fun_sleep(a=0.5)), worker.run_el(fun_sleep(a="x"))]
+    assert not futures[0].done()
+    worker.close()
+    assert futures[0].result().output.out == 0.5
+    with pytest.raises(TypeError):
+        futures[1].result()
@@ -1,10 +1,19 @@
 import os, time, pdb
+import asyncio
+import atexit
+import dataclasses as dc
+import importlib.util
 import multiprocessing as mp
+import shutil
+from tempfile import mkdtemp
+import threading
 
 # from pycon_utils import make_cluster
 from dask.distributed import Client
 import concurrent.futures as cf
 
+from .helpers import get_available_cpus, ensure_list
+
 import logging
 
 logger = logging.getLogger("nipype.workflow")
@@ -18,25 +27,135 @@ class Worker(object):
     def run_el(self):
         raise NotImplementedError
 
+    async def run_el_async(self, interface, **kwargs):
+        """awaiting the future returned by run_el"""
+        return await asyncio.wrap_future(self.run_el(interface, **kwargs))
+
     def close(self):
         raise NotImplementedError
 
+    def _save_template(self, interface):
+        """the node template of the job is saved in the directory of the worker,
+        so the processes of the pool read it once (it's not sent with every job)
+        """
+        template = getattr(interface, "template", None)
+        if template is not None:
+            template.save(self.templates_dir)
+
 
 class MpWorker(Worker):
-    def __init__(self, nr_proc=4):  # should be none
-        self.nr_proc = nr_proc
-        self.pool = mp.Pool(processes=self.nr_proc)
+    def __init__(self, nr_proc=None, max_jobs=None):
+        self.nr_proc = nr_proc or get_available_cpus()
+        self.pool = self._create_pool()
+        # maximal number of jobs that are submitted to the pool and not finished,
+        # run_el waits for a free slot when the limit is reached
+        self.max_jobs = max_jobs or 2 * self.nr_proc
+        self._slots = threading.BoundedSemaphore(self.max_jobs)
+        self.templates_dir = mkdtemp(prefix="pydra_templates_")
         logger.debug("Initialize MpWorker")
 
-    def run_el(self, interface, inp):
-        x = self.pool.apply_async(interface, inp)
-        # returning dir_nm_el and Result object for the specific element
-        return x.get()
+    def run_el(self, interface, **kwargs):
+        """submitting the job to the pool, returns a future with the Result"""
+        self._save_template(interface)
+        self._slots.acquire()
+        future = cf.Future()
+        future.set_running_or_notify_cancel()
+
+        def set_result(result):
+            self._slots.release()
+            future.set_result(result)
+
+        def set_exception(exc):
+            self._slots.release()
+            future.set_exception(exc)
+
+        self.pool.apply_async(
+            interface, kwds=kwargs, callback=set_result, error_callback=set_exception
+        )
+        return future
+
+    def _create_pool(self):
+        return mp.Pool(processes=self.nr_proc)
 
     def close(self):
         # added this method since I was having somtetimes problem with reading results from (existing) files
         # i thought that pool.close() should work, but still was getting some errors, so testing terminate
         self.pool.terminate()
+        shutil.rmtree(self.templates_dir, ignore_errors=True)
+
+
+# modules imported by the warm processes before the first task
+WARM_PRELOAD = ["pydra.engine.node", "pydra.engine.task", "cloudpickle", "numpy"]
+# pools shared by WarmPoolWorkers, key: (nr_proc, preload, max_tasks_per_child)
+_warm_pools = {}
+_warm_pools_lock = threading.Lock()
+
+
+class WarmPoolWorker(MpWorker):
+    """
+    MpWorker with a warm pool that is kept after the worker is closed
+    and reused by the next submitters with the same settings (e.g. in a long-lived service).
+    Processes are started by a forkserver with preloaded modules,
+    and are replaced after max_tasks_per_child tasks (to bound memory leaks).
+    """
+
+    def __init__(
+        self, nr_proc=None, max_jobs=None, preload=None, max_tasks_per_child=None
+    ):
+        """preload: list of modules (e.g. the user's libraries) imported by the processes"""
+        self.preload = preload
+        self.max_tasks_per_child = max_tasks_per_child
+        super(WarmPoolWorker, self).__init__(nr_proc=nr_proc, max_jobs=max_jobs)
+
+    def _create_pool(self):
+        return warm_pool(self.nr_proc, self.preload, self.max_tasks_per_child)
+
+    def close(self):
+        # the pool is kept for the next workers, close_warm_pools terminates it
+        shutil.rmtree(self.templates_dir, ignore_errors=True)
+
+
+def warm_pool(nr_proc, preload=None, max_tasks_per_child=None):
+    """process pool shared by all WarmPoolWorkers with the same settings"""
+    preload = tuple(WARM_PRELOAD + ensure_list(preload))
+    key = (nr_proc, preload, max_tasks_per_child)
+    # workers created in several threads get the same pool
+    with _warm_pools_lock:
+        if key not in _warm_pools:
+            for module in preload:
+                if importlib.util.find_spec(module) is None:
+                    raise Exception("module {} from preload not found".format(module))
+            if "forkserver" in mp.get_all_start_methods():
+                context = mp.get_context("forkserver")
+                # imported once by the server (if it's not running yet),
+                # the processes are forked from it
+                context.set_forkserver_preload(list(preload))
+            else:
+                context = mp.get_context("spawn")
+            _warm_pools[key] = context.Pool(
+                processes=nr_proc,
+                initializer=_preload,
+                initargs=(preload,),
+                maxtasksperchild=max_tasks_per_child,
+            )
+        return _warm_pools[key]
+
+
+def _preload(modules):
+    for module in modules:
+        importlib.import_module(module)
+
+
+def close_warm_pools():
+    """terminating the pools used by WarmPoolWorkers"""
+    with _warm_pools_lock:
+        pools = list(_warm_pools.values())
+        _warm_pools.clear()
+    for pool in pools:
+        pool.terminate()
+
+
+atexit.register(close_warm_pools)
 
 
 class SerialWorker(Worker):
@@ -44,48 +163,241 @@ class SerialWorker(Worker):
         logger.debug("Initialize SerialWorker")
         pass
 
-    def run_el(self, interface, inp):
-        res = interface(inp)
-        # returning dir_nm_el and Result object for the specific element
-        return res
+    def run_el(self, interface, **kwargs):
+        """running the job, returns a finished future with the Result"""
+        future = cf.Future()
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(interface(**kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
 
     def close(self):
         pass
 
 
+class AsyncWorker(Worker):
+    """running tasks as coroutines in one event loop (without thread or process pool),
+    shell commands are run as asyncio subprocesses;
+    run_el submits the jobs to the loop of the worker (running in its own thread),
+    run_el_async awaits the job in the running loop of the caller
+    """
+
+    def __init__(self, max_jobs=None):
+        # maximal number of tasks that are awaited at the same time (no limit if None)
+        self.max_jobs = max_jobs
+        # semaphores limiting the jobs, key: event loop
+        self._semaphores = {}
+        self._loop = None
+        self._thread = None
+        self._futures = set()
+        self._lock = threading.Lock()
+        logger.debug("Initialize AsyncWorker")
+
+    def run_el(self, interface, **kwargs):
+        """submitting the job to the event loop of the worker, returns a future with the Result"""
+        future = asyncio.run_coroutine_threadsafe(
+            self.run_el_async(interface, **kwargs), self._start_loop()
+        )
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    async def run_el_async(self, interface, **kwargs):
+        if self.max_jobs is None:
+            return await interface.run_async(**kwargs)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._semaphores:
+                self._semaphores[loop] = asyncio.Semaphore(self.max_jobs)
+            semaphore = self._semaphores[loop]
+        async with semaphore:
+            return await interface.run_async(**kwargs)
+
+    def _start_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="AsyncWorker", daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def close(self):
+        """waiting for the submitted jobs and stopping the event loop"""
+        with self._lock:
+            futures = list(self._futures)
+        cf.wait(futures)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+        self._semaphores = {}
+
+
 class ConcurrentFuturesWorker(Worker):
-    def __init__(self, nr_proc=4):
-        self.nr_proc = nr_proc
+    def __init__(self, nr_proc=None):
+        self.nr_proc = nr_proc or get_available_cpus()
         self.pool = cf.ProcessPoolExecutor(self.nr_proc)
+        self.templates_dir = mkdtemp(prefix="pydra_templates_")
         logger.debug("Initialize ConcurrentFuture")
 
     def run_el(self, interface, **kwargs):
+        self._save_template(interface)
         return self.pool.submit(interface, **kwargs)
 
     def close(self):
         self.pool.shutdown()
+        shutil.rmtree(self.templates_dir, ignore_errors=True)
+
+
+class ThreadWorker(Worker):
+    """running jobs in a thread pool of the current process (without pickling),
+    for tasks that release the GIL (e.g. numpy) or wait for I/O;
+    tasks that are not thread_safe run one at a time
+    """
+
+    def __init__(self, nr_proc=None):
+        self.nr_proc = nr_proc or get_available_cpus()
+        self.pool = cf.ThreadPoolExecutor(self.nr_proc)
+        self._lock = threading.Lock()
+        logger.debug("Initialize ThreadWorker")
+
+    def run_el(self, interface, **kwargs):
+        """submitting the job to the pool, returns a future with the Result"""
+        if getattr(interface, "thread_safe", False) and hasattr(
+            interface, "run_in_thread"
+        ):
+            return self.pool.submit(interface.run_in_thread, **kwargs)
+        return self.pool.submit(self._run_locked, interface, **kwargs)
+
+    def _run_locked(self, interface, **kwargs):
+        # the working directory can be changed only by one task
+        with self._lock:
+            if hasattr(interface, "run_in_thread"):
+                return interface.run_in_thread(change_dir=True, **kwargs)
+            return interface(**kwargs)
+
+    def close(self):
+        self.pool.shutdown()
 
 
 class DaskWorker(Worker):
-    def __init__(self):
+    """submitting jobs to a dask cluster (a new LocalCluster if address is not given),
+    jobs that use outputs of other jobs get the dask futures of these jobs,
+    so the dask scheduler handles the dependencies and data locality;
+    results are sent to the client only when they are used (or when the worker is closed)
+    """
+
+    def __init__(self, address=None, **cluster_kwargs):
+        """cluster_kwargs are passed to LocalCluster, e.g. n_workers, processes"""
         from distributed.deploy.local import LocalCluster
 
         logger.debug("Initialize Dask Worker")
-        # self.cluster = LocalCluster()
-        self.client = Client()  # self.cluster)
-        # print("BOKEH", self.client.scheduler_info()["address"] + ":" + str(self.client.scheduler_info()["services"]["bokeh"]))
-
-    def run_el(self, interface, inp):
-        print("DASK, run_el: ", interface, inp, time.time())
-        # dask  doesn't copy the node second time, so it doesn't see that I change input in the meantime (??)
-        x = self.client.submit(interface, inp)
-        print("DASK, status: ", x.status)
-        # this important, otherwise dask will not finish the job
-        x.add_done_callback(lambda x: print("DONE ", interface, inp))
-        print("res", x.result())
-        # returning dir_nm_el and Result object for the specific element
-        return x.result()
+        if address is None:
+            self.cluster = LocalCluster(**cluster_kwargs)
+            address = self.cluster
+        else:
+            self.cluster = None
+        self.client = Client(address)
+        # futures of the submitted jobs, results that are not used yet are gathered by close
+        self._futures = []
+
+    def run_el(self, interface, **kwargs):
+        """submitting the job, returns a future with the Result"""
+        return self._future(self.client.submit(interface, pure=False, **kwargs))
+
+    def run_el_graph(self, interface, upstream, **kwargs):
+        """submitting the job that uses outputs of other jobs,
+        upstream: dictionary with input name: (future of the upstream job, output name);
+        returns None if an upstream future is not from this worker
+        """
+        dask_futures = {
+            inp: getattr(future, "dask_future", None)
+            for inp, (future, _) in upstream.items()
+        }
+        if None in dask_futures.values():
+            return None
+        outputs = {inp: out for inp, (_, out) in upstream.items()}
+        return self._future(
+            self.client.submit(
+                _run_with_upstream, interface, outputs, pure=False, **dask_futures
+            )
+        )
+
+    def _future(self, dask_future):
+        future = DaskFuture(dask_future)
+        self._futures.append(future)
+        return future
 
     def close(self):
-        # self.cluster.close()
+        """waiting for all submitted jobs, the results are gathered at once,
+        so they can be used after the client is closed (errors are kept in the futures)
+        """
+        cf.wait(self._futures)
+        pending = [
+            future
+            for future in self._futures
+            if not future._gathered and future.exception() is None
+        ]
+        results = self.client.gather([future.dask_future for future in pending])
+        for future, result in zip(pending, results):
+            future._set_gathered(result)
+        self._futures = []
         self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+
+class DaskFuture(cf.Future):
+    """concurrent future of a dask job, it's done when the job is finished,
+    but the Result is kept on the cluster till result() is called
+    (dependent jobs get the dask future, so the Result is not sent to the client)
+    """
+
+    def __init__(self, dask_future):
+        super(DaskFuture, self).__init__()
+        self.set_running_or_notify_cancel()
+        self.dask_future = dask_future
+        self._gathered = False
+        self._dask_result = None
+        dask_future.add_done_callback(self._dask_done)
+
+    def _dask_done(self, dask_future):
+        if dask_future.status == "finished":
+            # the Result is gathered by result()
+            self.set_result(None)
+            return
+        try:
+            dask_future.result()
+        except BaseException as e:
+            self.set_exception(e)
+        else:
+            self.set_result(None)
+
+    def result(self, timeout=None):
+        """waiting for the job and gathering the Result from the cluster (only once)"""
+        super(DaskFuture, self).result(timeout)
+        if not self._gathered:
+            self._set_gathered(self.dask_future.result())
+        return self._dask_result
+
+    def _set_gathered(self, result):
+        self._dask_result = result
+        self._gathered = True
+
+
+def _run_with_upstream(job, outputs, **results):
+    """running the job with inputs from the results of the upstream jobs"""
+    inputs = dict(job.inputs)
+    for inp, result in results.items():
+        inputs[inp] = getattr(result.output, outputs[inp])
+    return dc.replace(job, inputs=inputs)()
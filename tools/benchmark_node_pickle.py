@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Size and time of pickling one job node, compared with the previous node state
+(specs pickled separately inside the state, inputs copied with dc.asdict).
+
+    python tools/benchmark_node_pickle.py [number of jobs]
+"""
+import dataclasses as dc
+import pickle as pk
+import sys
+import time
+
+import cloudpickle as cp
+
+from pydra.engine.task import to_task
+
+
+@to_task
+def fun_sum(a, b):
+    return sum(a) + b
+
+
+def legacy_state(node):
+    state = node.__dict__.copy()
+    state["input_spec"] = pk.dumps(state["input_spec"])
+    state["output_spec"] = pk.dumps(state["output_spec"])
+    state["inputs"] = dc.asdict(state["inputs"])
+    return state
+
+
+def timeit(fun, nr):
+    t0 = time.perf_counter()
+    for _ in range(nr):
+        out = fun()
+    return (time.perf_counter() - t0) / nr, out
+
+
+def main(nr_jobs=1000):
+    node = fun_sum(name="NA", a=[float(i) for i in range(10000)], b=1)
+    dt_legacy, legacy = timeit(lambda: cp.dumps(legacy_state(node)), nr_jobs)
+    dt_compact, compact = timeit(lambda: cp.dumps(node), nr_jobs)
+    dt_load, _ = timeit(lambda: cp.loads(compact), nr_jobs)
+    print("pickle size: legacy {} B, compact {} B".format(len(legacy), len(compact)))
+    print(
+        "pickle time per job: legacy {:.1f} us, compact {:.1f} us".format(
+            dt_legacy * 1e6, dt_compact * 1e6
+        )
+    )
+    print("unpickle time per job (compact): {:.1f} us".format(dt_load * 1e6))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])